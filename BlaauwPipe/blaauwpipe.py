@@ -7,14 +7,30 @@ from core.pluginsystem import PluginCollector
 
 import argparse
 from astropy.io import fits
-from datetime import datetime, timedelta
+from datetime import datetime
+from functools import lru_cache
+import io
 import logging
 import numpy as np
 import os
+import re
 import sys
+import threading
 import time
 import warnings
 
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+# Maps (path, mtime) to the parsed DATE-OBS of a file. Master frames are not
+# altered once written, so every file only needs to be parsed once per run
+_dateobs_cache = {}
+
+# Maps a correction dir to an index of its master frames, see get_master_index
+_master_index = {}
+
 #--------------------DEBUG-ONLY---------------------#
 from importlib import reload
 mods = [cst]
@@ -24,18 +40,50 @@ for mod in mods:
 
 class BlaauwPipe(object):
     
+    # Tuple of the collected (core, external) plugins, see refresh_plugins
+    _plugin_cache = None
+    
     def __init__(self):
         self.print_logo()
         
         # Retrieve the arguments, and the specified targets
         self.load_args()
         
+        # Set up the logging module, the logfiles are made per target
+        self.init_logging()
+        
     def print_logo(self):
         print(cst.logo)
         print(cst.cr)
         print("")
 
+    def init_logging(self):
+        """ Configures the logging module once. Every target gets its own
+            logfile, see set_logfile(), but they all share this setup.
+        """
+        logging.getLogger().setLevel(logging.DEBUG)
+        self.log_formatter = logging.Formatter(fmt='%(asctime)s %(levelname)s %(module)s - %(funcName)s: %(message)s',
+                                               datefmt='%Y-%m-%d %H:%M:%S.%03d')
+        self.log_handler = None
+        
+    def set_logfile(self, logfile_path):
+        """ Redirects all log records to the file at logfile_path. Only the 
+            file handler of the previous target is replaced, instead of
+            reconfiguring the logging module for every target.
+        """
+        root_logger = logging.getLogger()
+        if self.log_handler is not None:
+            root_logger.removeHandler(self.log_handler)
+            self.log_handler.close()
+            
+        self.log_handler = logging.FileHandler(logfile_path)
+        self.log_handler.setFormatter(self.log_formatter)
+        root_logger.addHandler(self.log_handler)
+
     def start(self):
+        # The selected plugins are the same for every target, so collect them once
+        self.get_plugins()
+        
         # Loop over every target that was found and perform the actions 
         # that were specified in the command line arguments
         for self.target in self.targets:
@@ -57,14 +105,12 @@ class BlaauwPipe(object):
                 pass
             else:
                 os.makedirs(self.working_dir)
+                # This may have created a new date folder, which the cached lookups don't know of
+                BlaauwPipe.clear_dir_cache()
                 
             # Initialize log file
             logfile_path = os.path.join(self.working_dir, cst.logfile)
-            logging.basicConfig(filename=logfile_path, 
-                                level=logging.DEBUG, 
-                                force=True, 
-                                format='%(asctime)s %(levelname)s %(module)s - %(funcName)s: %(message)s',
-                                datefmt='%Y-%m-%d %H:%M:%S.%03d')
+            self.set_logfile(logfile_path)
             logging.info("Blaauwpipe: " + cst.cr)
             ps.done(f"Logfile created at {BlaauwPipe.strip_filepath(logfile_path)}")
             
@@ -76,7 +122,6 @@ class BlaauwPipe(object):
             ps.newline()
 
             # Perform core functions
-            self.get_plugins()
             self.run_plugins()
             
         if not self.targets:
@@ -203,7 +248,8 @@ class BlaauwPipe(object):
         """
         target=self.target; args=self.args
         ps.running(f"Looking for files in {self.target}")
-        self.obs = Observation(target)  
+        index_path = os.path.join(self.working_dir, cst.obs_index)
+        self.obs = Observation(target, index_path=index_path)
         self.check_obs()
         ps.done("Observation Object initialized")
         
@@ -241,7 +287,7 @@ class BlaauwPipe(object):
             subdirs = [os.path.join(folder, subdir) for subdir in cst.tele_subsubdirs]
             targets = []
             for subdir in subdirs:
-                if len(os.listdir(subdir)) > 0:
+                if BlaauwPipe.has_content(subdir):
                     targets.append(subdir)
 
         elif BlaauwPipe.is_valid_date(os.path.basename(os.path.normpath(folder)), "%y%m%d"):
@@ -250,7 +296,7 @@ class BlaauwPipe(object):
             for subdir in subdirs:
                 for subsubdir in cst.tele_subsubdirs:
                     cur_folder = os.path.join(subdir, subsubdir)
-                    if os.path.isdir(cur_folder) and len(os.listdir(cur_folder)) > 0:
+                    if BlaauwPipe.isdir_cached(cur_folder) and BlaauwPipe.has_content(cur_folder):
                         targets.append(cur_folder)
 
         else:
@@ -278,11 +324,11 @@ class BlaauwPipe(object):
         
     def get_plugins(self):
         # Backup - Correction - Reduce - Astrometry - External
-        # Collect all core plugins
-        self.core_plugins = PluginCollector("core").plugins
-        
-        # Collect all external plugins
-        self.extra_plugins = PluginCollector("plugins").plugins
+        # Collecting the plugins means importing every module in their packages,
+        # so this is done only once and the result is stored at class level
+        if BlaauwPipe._plugin_cache is None:
+            BlaauwPipe.refresh_plugins()
+        self.core_plugins, self.extra_plugins = BlaauwPipe._plugin_cache
         
         # Select only the enabled plugins and save them to self.plugins
         arg_plugins = [k for k, v in vars(self.args).items() if v == True]
@@ -302,11 +348,28 @@ class BlaauwPipe(object):
             ps.module(f"Plugin {plugin.title} executed!")
             ps.newline()
 
+    @staticmethod
+    def refresh_plugins():
+        """ (Re)collects all core and external plugins and stores them in the 
+            class-level plugin cache. Only needed when plugins were changed 
+            while the pipeline is running, e.g. during development.
+        """
+        # Collect all core plugins
+        core_plugins = PluginCollector("core").plugins
+        
+        # Collect all external plugins
+        extra_plugins = PluginCollector("plugins").plugins
+        
+        BlaauwPipe._plugin_cache = (core_plugins, extra_plugins)
+
     def run_plugins_single(self, obs, plp, args, file, called_from):
-        # Collect all plugins
-        loaded_plugins = PluginCollector()
+        # Get the external plugins from the plugin cache
+        if BlaauwPipe._plugin_cache is None:
+            BlaauwPipe.refresh_plugins()
+        core_plugins, extra_plugins = BlaauwPipe._plugin_cache
+        
         # Execute each plugin for a specific file only
-        for plugin in loaded_plugins.plugins:
+        for plugin in extra_plugins:
             # Only rerun plugin if specified by plugin
             # TODO: not really elegant to compare strings...
             if (called_from == "pending" and plugin.rerun_on_pending) or \
@@ -320,6 +383,49 @@ class BlaauwPipe(object):
     #               Misc. utils               #
     #-----------------------------------------#
     
+    @staticmethod
+    def has_content(path):
+        """ Returns whether the directory at path contains anything. Stops
+            reading the directory as soon as the first entry is found.
+        """
+        with os.scandir(path) as entries:
+            return any(True for _ in entries)
+    
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def isdir_cached(path):
+        """ Cached version of os.path.isdir. Stat calls are expensive on the 
+            network filesystems the pipeline runs on, while the same dirs are
+            checked over and over again. Call clear_dir_cache() after writing 
+            new files to disk.
+        """
+        return os.path.isdir(path)
+    
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def get_date_folders(parent):
+        """ Returns the names of all date folders (e.g. 210319) in parent. The
+            date folders are only listed once, until clear_dir_cache() is called
+            without a directory. Writing files never creates new date folders, 
+            only start() does, which therefore clears the whole cache.
+        """
+        if not BlaauwPipe.isdir_cached(parent): return ()
+        with os.scandir(parent) as entries:
+            return tuple(entry.name for entry in entries 
+                         if len(entry.name) == 6 and entry.name.isdigit() and entry.is_dir())
+    
+    @staticmethod
+    def clear_dir_cache(directory=None):
+        """ Clears the cached directory lookups. If a directory is passed, only
+            the master index of that directory is dropped, as writing a file 
+            does not change the content of any other directory.
+        """
+        BlaauwPipe.isdir_cached.cache_clear()
+        if directory is None: 
+            _master_index.clear()
+            BlaauwPipe.get_date_folders.cache_clear()
+        else: _master_index.pop(directory, None)
+    
     @staticmethod
     def get_closest_master(target_datetime, plp, max_days_off, binning, frame_type, fltr=""):
         """ Function that returns the closest file to target_datetime, given the
@@ -329,79 +435,113 @@ class BlaauwPipe(object):
             its search range to nearby dates when still no suitable files were found.
             Then, orders the potential files on creation time and returns the closest.
         """
-        # Set the filename requirements
+        # Set the filename requirements, which appear in this order in the filename
         requirements = [frame_type, binning, fltr]
-        potential_files = []
+        pattern = re.compile(".*".join(re.escape(req) for req in requirements if req))
 
         # First, look in the current workspace if there exist suitable files.
-        # If yes, add them to a list, which will later be sorted on creation time.
-        for filename in os.listdir(plp.cor_dir):
-            # Requirements that filename should satisfy
-            if not all(req in filename for req in requirements):
-                continue
-            # File satisfying the requirements found, so add its we add the filepath
-            # and its creation time to the potentials list. The third argument, being
-            # 0 here, represents the 'relative age' of this frame, see 'days_off'.
-            file = os.path.join(plp.cor_dir, filename)
-            creation_time = datetime.strptime(fits.getval(file, 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f")
-            potential_files.append([file, creation_time, 0])
+        # The candidates are kept as parallel arrays, holding their filepaths,
+        # their creation times and their 'relative ages', see 'days_off'.
+        paths, creation_times = BlaauwPipe.find_masters(plp.cor_dir, pattern)
+        days_offs = np.zeros(len(paths), dtype=int)
 
         # If we somehow still don't have any potential master files, we could look 
-        # into directories of 'nearby' dates. We increase days_off by 1 each iteration
-        # and check both the 'past' and the 'future' folders for suitable files
+        # into directories of 'nearby' dates. Only the date folders that exist can hold
+        # masters, so instead of trying every date up to max_days_off, the existing ones 
+        # are grouped on their distance in days to the current date folder
         folder_date = plp.working_dir.replace(cst.base_path, '').split(os.sep)[1]
-        folder_datetime = datetime.strptime(folder_date, '%y%m%d')
-        days_off = 1
-        while len(potential_files) == 0:
-            # Construct the 'future' datefolder corresponding to days_off
-            next_cor_date = (folder_datetime + timedelta(days=days_off)).date().strftime('%y%m%d')
-            next_cor_dir = plp.cor_dir.replace(folder_date, next_cor_date)
-
-            # If the future dir exists, start looking into its content
-            if os.path.exists(next_cor_dir) and os.path.isdir(next_cor_dir):
-                for filename in os.listdir(next_cor_dir):
-                    # Requirements that filename should satisfy
-                    if not all(req in filename for req in requirements):
-                        continue
-                    # File satisfying the requirements found, so add its we add the filepath
-                    # and its creation time to the potentials list. The third argument, 
-                    # 'days_off' keeps track of the relative age of this frame.
-                    file = os.path.join(next_cor_dir, filename)
-                    creation_time = datetime.strptime(fits.getval(file, 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f")
-                    potential_files.append([file, creation_time, days_off])
-
-            # Construct the 'past' datefolder corresponding to -days_off
-            prev_cor_date = (folder_datetime - timedelta(days=days_off)).date().strftime('%y%m%d')
-            prev_cor_dir = plp.cor_dir.replace(folder_date, prev_cor_date)
-
-            # If past dir exists, start looking into its content.
-            if os.path.exists(prev_cor_dir) and os.path.isdir(prev_cor_dir):
-                for filename in os.listdir(prev_cor_dir):
-                    # Requirements that filename should satisfy
-                    if not all(req in filename for req in requirements):
-                        continue
-                    # File satisfying the requirements found, so add its we add the filepath
-                    # and its creation time to the potentials list. The third argument, 
-                    # 'days_off' keeps track of the relative age of this frame.
-                    file = os.path.join(prev_cor_dir, filename)
-                    creation_time = datetime.strptime(fits.getval(file, 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f")
-                    potential_files.append([file, creation_time, -days_off])
-
-            # Increase the search range by one day for next iteration.
-            days_off += 1
-
-            # Hopefully never happens, but just in case
-            if days_off > max_days_off:
-                raise ers.SuitableMasterMissingError(
-                    f"Could not find a suitable {frame_type} of binning {binning}")
-
-        # Sort the potential files on creation time:
-        # The files closest to target_datetime, will be the first element.
-        closest = min(potential_files, key=lambda file: abs(file[1] - target_datetime))
-        closest_master = fits.getdata(closest[0], 0)
+        folder_datetime = BlaauwPipe.parse_folder_date(folder_date)
+        
+        # Split cor_dir around its date folder once, so the nearby folders can
+        # be constructed by plain concatenation inside the loop
+        cor_parent, _, cor_tail = plp.cor_dir.rpartition(folder_date)
+        nearby_dates = {}
+        if len(paths) == 0:
+            for cor_date in BlaauwPipe.get_date_folders(cor_parent):
+                try:
+                    days_off = (BlaauwPipe.parse_folder_date(cor_date) - folder_datetime).days
+                except ValueError:
+                    continue
+                if 0 < abs(days_off) < max_days_off:
+                    nearby_dates.setdefault(abs(days_off), []).append((days_off, cor_date))
+        
+        # Check both the 'future' and the 'past' folder of the nearest distance first,
+        # and only move on to the next distance if still no suitable files were found
+        for distance in sorted(nearby_dates):
+            for days_off, cor_date in sorted(nearby_dates[distance], reverse=True):
+                cor_dir = cor_parent + cor_date + cor_tail
+
+                # If the dir exists, add its suitable files to the candidates.
+                # 'days_off' keeps track of the relative age of these frames.
+                if BlaauwPipe.isdir_cached(cor_dir):
+                    near_paths, near_times = BlaauwPipe.find_masters(cor_dir, pattern)
+                    paths = np.append(paths, near_paths)
+                    creation_times = np.append(creation_times, near_times)
+                    days_offs = np.append(days_offs, np.full(len(near_paths), days_off))
+            
+            if len(paths) > 0: break
+
+        # Hopefully never happens, but just in case
+        if len(paths) == 0:
+            raise ers.SuitableMasterMissingError(
+                f"Could not find a suitable {frame_type} of binning {binning}")
+
+        # Find the file whose creation time is closest to target_datetime
+        closest = np.argmin(np.abs(creation_times - np.datetime64(target_datetime, 'us')))
+        closest_path = str(paths[closest])
+        closest_master = BlaauwPipe.load_master(closest_path, os.stat(closest_path).st_mtime_ns)
 
         # Return the data of the closest master, its path and its days_off.
-        return closest_master, closest[0], closest[2]
+        return closest_master, closest_path, int(days_offs[closest])
+    
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def load_master(path, mtime_ns):
+        """ Function that returns the data of the master frame at path. The 
+            same few masters are requested for every cluster and light file, 
+            so the data is cached on path and modification time. The returned
+            array is shared between callers and hence made read-only.
+        """
+        # Single precision is plenty for correction frames, and halves the 
+        # memory traffic of all the frame arithmetic that follows
+        master = fits.getdata(path, 0).astype(np.float32, copy=False)
+        master.setflags(write=False)
+        return master
+    
+    @staticmethod
+    def get_master_index(cor_dir):
+        """ Function that returns an index of all the master frames in cor_dir.
+            The index is a dict of parallel numpy arrays, holding the filenames
+            and the filepaths of the frames. It is built only once per directory,
+            until clear_dir_cache() is called. No headers are read here, as only
+            the few frames that match a search are needed, see find_masters.
+        """
+        # Keep a reference, as another thread may clear the cache at any time
+        index = _master_index.get(cor_dir)
+        if index is None:
+            # A single scandir pass gives both the filenames and their full paths
+            with os.scandir(cor_dir) as entries:
+                files = [(entry.name, entry.path) for entry in entries if entry.name.endswith(".fits")]
+            names = [name for name, _ in files]
+            paths = [path for _, path in files]
+            index = _master_index[cor_dir] = {
+                "names": np.array(names, dtype=str),
+                "paths": np.array(paths, dtype=str)
+            }
+        return index
+    
+    @staticmethod
+    def find_masters(cor_dir, pattern):
+        """ Function that returns the paths and creation times of the master 
+            frames in cor_dir whose filename matches the compiled pattern. Only
+            the headers of the matching frames are read, and their creation 
+            times are cached per file, see get_creation_time.
+        """
+        index = BlaauwPipe.get_master_index(cor_dir)
+        mask = np.array([pattern.search(name) is not None for name in index["names"]], dtype=bool)
+        paths = index["paths"][mask]
+        creation_times = np.array([BlaauwPipe.get_creation_time(str(path)) for path in paths], dtype="datetime64[us]")
+        return paths, creation_times
     
     
     #-----------------------------------------#
@@ -411,8 +551,7 @@ class BlaauwPipe(object):
     @staticmethod
     def header_add_source(header, files):
         header.set(cst.HKW_nsource, str(len(files)))
-        for filepath in files:
-            ind = files.index(filepath)
+        for ind, filepath in enumerate(files):
             header.set(cst.HKW_source + str(ind+1), str(filepath))
         return header
 
@@ -452,20 +591,96 @@ class BlaauwPipe(object):
             header.set(cst.HKW_mflat_age, days_off)
         return header
 
+    @staticmethod
+    def update_header(filepath, header_add, *args, **kwargs):
+        """ Applies one of the header_add_* functions to the header of the
+            file at filepath. The file is opened in update mode, so only the
+            header is rewritten on disk, while the data is left untouched.
+        """
+        with fits.open(filepath, mode="update") as hdul:
+            header_add(hdul[0].header, *args, **kwargs)
+
     @staticmethod
     def save_fits(save_path, data=None, header=None, overwrite=True):
         """ Takes the content of a fits file and saves it 
             as a new fits file at save_path
         """
+        # Single precision is plenty for the pipeline products, and halves the bytes written.
+        # Only done for newly passed data, so data already on disk is written back unchanged
+        if data is not None and np.issubdtype(data.dtype, np.floating): data = data.astype(np.float32, copy=False)
         if os.path.exists(save_path) and data is None: data=fits.getdata(save_path)
         if os.path.exists(save_path) and header is None: header=fits.getheader(save_path)
         hduNew = fits.PrimaryHDU(data, header=header)
-        hduNew.writeto(save_path, overwrite=overwrite)
+        BlaauwPipe.write_fits(hduNew, save_path, overwrite=overwrite)
+
+    @staticmethod
+    def write_fits(hdul, save_path, overwrite=True):
+        """ Writes the passed HDU (list) to save_path. Astropy writes a file in
+            many small chunks, which is very slow on network filesystems. So
+            we let it write to memory first and then write to disk in one go.
+            The file is written under a temporary name in the same folder and 
+            then moved into place, so that other threads reading the folder 
+            never see a half written file.
+        """
+        buffer = io.BytesIO()
+        hdul.writeto(buffer)
+        
+        # Unique per thread, and not ending in .fits, so it's never taken for a master frame
+        temp_path = f"{save_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(buffer.getbuffer())
+            if overwrite:
+                os.replace(temp_path, save_path)
+            else:
+                # Unlike a rename, a link fails when save_path already exists
+                os.link(temp_path, save_path)
+        finally:
+            if os.path.exists(temp_path): os.remove(temp_path)
+        BlaauwPipe.clear_dir_cache(os.path.dirname(save_path))
 
     @staticmethod
     def get_kw(filepath, keyword):
         val = fits.getheader(filepath, 0)[keyword]
         return val
+
+    @staticmethod
+    def get_dateobs(filepath):
+        """ Returns the raw DATE-OBS string of the passed file. Only the
+            header is read, using fitsio's C parser when it is installed
+            and falling back on astropy otherwise.
+        """
+        if fitsio is not None:
+            return fitsio.read_header(filepath, 0)['DATE-OBS']
+        return fits.getval(filepath, 'DATE-OBS')
+
+    @staticmethod
+    def get_creation_time(filepath):
+        """ Returns the DATE-OBS of the passed file as a datetime object. The
+            result is cached on the path and modification time of the file, 
+            so the header is only parsed again once the file was rewritten.
+        """
+        key = (filepath, os.stat(filepath).st_mtime_ns)
+        if key not in _dateobs_cache:
+            _dateobs_cache[key] = BlaauwPipe.parse_dateobs(BlaauwPipe.get_dateobs(filepath))
+        return _dateobs_cache[key]
+
+    @staticmethod
+    def parse_dateobs(date_obs):
+        """ Converts a DATE-OBS string to a datetime object. Gives the same result
+            as datetime.strptime(date_obs, "%Y-%m-%dT%H:%M:%S.%f"), but slices the
+            fixed-width fields directly instead of interpreting a format string.
+        """
+        return datetime(int(date_obs[0:4]), int(date_obs[5:7]), int(date_obs[8:10]),
+                        int(date_obs[11:13]), int(date_obs[14:16]), int(date_obs[17:19]),
+                        int(date_obs[20:26].ljust(6, "0")))
+
+    @staticmethod
+    def parse_folder_date(folder_date):
+        """ Converts the name of a date folder, e.g. 210319, to a datetime object.
+            Gives the same result as datetime.strptime(folder_date, '%y%m%d').
+        """
+        return datetime(2000 + int(folder_date[0:2]), int(folder_date[2:4]), int(folder_date[4:6]))
         
 def main():
     bp = BlaauwPipe()
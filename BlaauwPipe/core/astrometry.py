@@ -5,13 +5,24 @@ import core.printstatus as ps
 from astrometry_net_client import Client
 from astropy.io import fits
 from astropy.stats import sigma_clipped_stats
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
 import os
 from photutils import DAOStarFinder
 
+# sep runs the source extraction in C, and is used instead of photutils when available
+try:
+    import sep
+except ImportError:
+    sep = None
+
 import logging
 log = logger = logging.getLogger(__name__)
 from blaauwpipe import BlaauwPipe
 
+# Maps (path, mtime) to the number of sources found in that file
+_source_counts = {}
+
 class Astrometry(Plugin):
     def __init__(self):
         super().__init__()
@@ -53,27 +64,61 @@ class Astrometry(Plugin):
 
     @staticmethod
     def find_sources(filename, detect_threshold=20, fwhm=3):
-        with fits.open(filename) as f:
-            data = f[0].data
+        # Map the file into memory instead of reading it, and work in float32 
+        # so the median-subtracted copy below takes half the memory
+        with fits.open(filename, memmap=True) as f:
+            data = f[0].data.astype(np.float32, copy=False)
+        
+        # Use the C implementation of sep if possible, photutils otherwise
+        if sep is not None:
+            bkg = sep.Background(data)
+            return sep.extract(data - bkg, detect_threshold, err=bkg.globalrms)
+        
         # find sources
         mean, median, std = sigma_clipped_stats(data, sigma=3.0, maxiters=5)
         daofind = DAOStarFinder(fwhm=fwhm, threshold=detect_threshold * std)
-        sources = daofind(data - median)
+        # median is a float64 scalar, which would upcast the subtraction again
+        sources = daofind((data - median).astype(np.float32, copy=False))
         return sources
 
+    @staticmethod
+    def count_sources(filename):
+        # sources is None when no sources are found
+        sources = Astrometry.find_sources(filename)
+        return len(sources) if sources is not None else 0
+
     @staticmethod
     def enough_sources(filename, min_sources=5):
-        sources = self.find_sources(filename)
+        # The source count of a file is cached on its path and modification
+        # time, so reruns don't have to search the same frames again
+        key = (filename, os.stat(filename).st_mtime_ns)
+        if key not in _source_counts:
+            _source_counts[key] = Astrometry.count_sources(filename)
+        num_sources = _source_counts[key]
+        
         # terminate if not enough are found.
-        # sources is None when no sources are found
-        num_sources = len(sources) if sources is not None else 0
-        if sources is None or num_sources < min_sources:
+        if num_sources < min_sources:
             msg = "{}: Not enough sources found: {} found, {} wanted."
-            print(msg.format(filename, num_sources, min_sources))
+            logger.info(msg.format(filename, num_sources, min_sources))
             return False
-        print("{}: Found {} sources".format(filename, num_sources))
+        logger.info("{}: Found {} sources".format(filename, num_sources))
         return True
 
+    @staticmethod
+    def filter_sources(files, min_sources=5):
+        """ Returns the files that contain at least min_sources stars. Frames
+            with fewer stars are not worth the round-trip to astrometry.net.
+            Source detection is CPU bound, so the uncached files are searched
+            in parallel processes first.
+        """
+        todo = [file for file in files if (file, os.stat(file).st_mtime_ns) not in _source_counts]
+        if todo:
+            with ProcessPoolExecutor() as executor:
+                for file, num_sources in zip(todo, executor.map(Astrometry.count_sources, todo)):
+                    _source_counts[(file, os.stat(file).st_mtime_ns)] = num_sources
+                    
+        return [file for file in files if Astrometry.enough_sources(file, min_sources)]
+
     def main(self, obs, plp):
         ps.running("Initializing client...")
         c = Client(api_key=cst.api_key)
@@ -84,43 +129,58 @@ class Astrometry(Plugin):
         c.settings.set_scale_range(15, 30)
         #c.settings.use_sextractor = True
 
-        # Get the raw & corresponding reduced files
-        fits_files = plp.red_files[:3]
-
-        # give the iterable of filenames to the function, which returns a
-        # generator, generating pairs containing the finished job and filename.
-        ps.running("Preparing files for uploading...")
-        result_iter = c.upload_files_gen(fits_files)#, filter_func=self.enough_sources)
-        ps.updateDone("Light files are ready for Astrometry")
+        # Get the raw & corresponding reduced files, but skip those with too few
+        # stars: astrometry.net would spend minutes failing to solve them
+        ps.running("Looking for sources in light files...")
+        fits_files = self.filter_sources(plp.red_files)
+        ps.updateDone(f"{len(fits_files)} of {len(plp.red_files)} light files contain enough sources")
 
+        # Each upload mostly waits for astrometry.net to solve the field, so 
+        # have several uploads in flight at once and handle them as they finish
+        ps.running("Uploading light files to Astrometry...")
         file_counter = 0
         success_counter = 0
         
-        for job, filename in result_iter:
-            if not job.success():
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {executor.submit(self.process_file, c, filename, plp): filename for filename in fits_files}
+            
+            for future in as_completed(futures):
+                filename = futures[future]
+                astrom_file = future.result()
                 file_counter += 1
-                ps.progressBar(file_counter, len(fits_files), f"Astrometry failed for {BlaauwPipe.strip_filepath(filename)}")
+                
+                if astrom_file is None:
+                    ps.progressBar(file_counter, len(fits_files), f"Astrometry failed for {BlaauwPipe.strip_filepath(filename)}")
+                    ps.newline()
+                    continue
+
+                success_counter += 1
+                ps.progressBar(file_counter, len(fits_files), f"Astrometry results are saved to {BlaauwPipe.strip_filepath(astrom_file)}")
                 ps.newline()
-                continue
-
-            # retrieve the wcs file from the successful job
-            wcs = job.wcs_file()
-            file_counter += 1
-            success_counter += 1
-            ps.progressBar(file_counter, len(fits_files), f"Received WCS for {BlaauwPipe.strip_filepath(filename)}")
-            ps.newline()
-            
-            with fits.open(filename) as hdul:
-                # append resulting header (with astrometry) to existing header
-                hdul[0].header.extend(wcs)
-
-                astrom_file = self.change_filename(filename, plp)
-                ps.running(f"Writing to {BlaauwPipe.strip_filepath(astrom_file)}...")
-                hdul.writeto(astrom_file)
-                ps.updateDone(f"Astrometry results are saved to {BlaauwPipe.strip_filepath(astrom_file)}")
                             
         if success_counter > 0:
             ps.done(f"{success_counter} files were successfully run through Astrometry!")
         if file_counter-success_counter > 0:
             ps.warning(f"{file_counter-success_counter} files could not be resolved!")
-        
\ No newline at end of file
+            
+    def process_file(self, client, filename, plp):
+        """ Uploads a single file to Astrometry and blocks until it is solved.
+            On success, the WCS result is appended to the header and the file
+            is saved to plp.red_dir. Returns the path to this new file, or None
+            when Astrometry failed.
+        """
+        job = client.upload_file(filename)
+        if not job.success():
+            return None
+
+        # retrieve the wcs file from the successful job
+        wcs = job.wcs_file()
+        
+        with fits.open(filename) as hdul:
+            # append resulting header (with astrometry) to existing header
+            hdul[0].header.extend(wcs)
+
+            astrom_file = self.change_filename(filename, plp)
+            BlaauwPipe.write_fits(hdul, astrom_file, overwrite=False)
+            
+        return astrom_file
@@ -1,7 +1,8 @@
 from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import os
-from shutil import copy2
+from shutil import copy2, copystat
 import stat
 
 import core.constants as cst
@@ -36,26 +37,66 @@ class Backup(Plugin):
             
         ps.done(f"Savepath created at {BlaauwPipe.strip_filepath(plp.raw_dir)}")
 
-        # Make a copy of each file
-        for ori_file in obs.files:
-            filename = os.path.basename(ori_file)
-            filepath = os.path.join(plp.raw_dir, filename)
+        # Make a copy of each file. Copying is I/O bound, so a couple of
+        # threads can have multiple files in flight at the same time
+        n_files = len(obs.files)
+        max_workers = min(8, os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.backup_file, ori_file, plp.raw_dir) for ori_file in obs.files]
             
-            # Update user
-            ps.progressBar(obs.files.index(ori_file), len(obs.files), f"Copying file to backup: {filename}")
-            
-            # Copy files
-            copy2(ori_file, filepath)
-            
-            # Use chmod to ensure write permission (- rw- r-- r--)
-            os.chmod(filepath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IWUSR)
-
-            # Add header keyword TRAW
-            header = fits.getheader(filepath)
-            header = BlaauwPipe.header_add_traw(header, ori_file)
-            BlaauwPipe.save_fits(filepath, header=header)
+            # Update user whenever a file has been copied
+            for file_counter, future in enumerate(as_completed(futures)):
+                filename = os.path.basename(future.result())
+                ps.progressBar(file_counter, n_files, f"Copying file to backup: {filename}")
             
         ps.updateDone(f"Copying files done", progressbar=True)
         ps.done(f"Changed file permissions to rw-r--r--")
         ps.done(f"Added TRAW keyword to headers")
-        ps.done(f"Successfully copied and prepared {len(obs.files)} files!")
\ No newline at end of file
+        ps.done(f"Successfully copied and prepared {n_files} files!")
+        
+    @staticmethod
+    def backup_file(ori_file, raw_dir):
+        """ Copies a single file to raw_dir, makes it writable and adds
+            the TRAW header keyword. Returns the path of the copy.
+        """
+        filename = os.path.basename(ori_file)
+        filepath = os.path.join(raw_dir, filename)
+        
+        # Copy files
+        Backup.fast_copy(ori_file, filepath)
+        
+        # Use chmod to ensure write permission (- rw- r-- r--)
+        os.chmod(filepath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IWUSR)
+        
+        # Add header keyword TRAW. setval updates the header in place, so the 
+        # data block of the copy is not read or written again
+        fits.setval(filepath, cst.HKW_traw, value=str(ori_file))
+        
+        return filepath
+    
+    @staticmethod
+    def fast_copy(src, dst):
+        """ Copies src to dst including its metadata, like copy2. On Linux,
+            copy_file_range lets the kernel copy the bytes directly between
+            the two files, without passing them through user space.
+        """
+        if not hasattr(os, "copy_file_range"):
+            copy2(src, dst)
+            return
+        
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    # Stop instead of looping forever when nothing is copied
+                    if copied == 0: break
+                    remaining -= copied
+            except OSError:
+                pass
+        
+        # Not every filesystem supports an in-kernel copy, finish the job the usual way
+        if remaining > 0:
+            copy2(src, dst)
+            return
+        copystat(src, dst)
\ No newline at end of file
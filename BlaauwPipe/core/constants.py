@@ -38,6 +38,12 @@ reduced_dir = "Reduced"
 correction_dir = "Correction"
 pending_log = "pending_log.csv"
 logfile = "logfile.txt"
+obs_index = "obs_index.h5"
+
+# Filename templates of the master correction frames
+mbias_filename = "master_bias{binning}C{index}.fits"
+mdark_filename = "master_dark{binning}C{index}.fits"
+mflat_filename = "master_flat{binning}{fltr}C{index}.fits"
 
 
 #-----------------------------------------#
@@ -1,8 +1,8 @@
 from astropy.io import fits
-from datetime import datetime, timedelta
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
 import os
-import warnings
+import re
 
 import core.constants as cst
 import core.errors as ers
@@ -14,6 +14,11 @@ import logging
 logger = logging.getLogger(__name__)
 from blaauwpipe import BlaauwPipe
 
+# Patterns that retrieve the cluster number from the master frame filenames,
+# the counterparts of the filename templates in constants.py
+mdark_pattern = re.compile(r"master_dark(?P<binning>\d+x\d+|\?)C(?P<index>\d+)\.fits")
+mflat_pattern = re.compile(r"master_flat(?P<binning>\d+x\d+|\?)(?P<fltr>.*)C(?P<index>\d+)\.fits")
+
 class Correction(Plugin):
     def __init__(self):
         super().__init__()
@@ -45,28 +50,64 @@ class Correction(Plugin):
         binnings = obs.get_binnings(plp.lightFiles)
         fltrs = obs.get_filters(plp.flatFiles)
 
-        # Loop over every possible binning
-        for binning in binnings:
-            # Handle the master bias
-            b_clusters = plp.get_bias_clusters(binning)
-            for b_cluster in b_clusters:
-                self.create_mbias(obs, plp, b_cluster, b_clusters.index(b_cluster))
-
-            # Handle the master dark
-            d_clusters = plp.get_dark_clusters(binning)
-            for d_cluster in d_clusters:
-                self.create_mdark(obs, plp, d_cluster, d_clusters.index(d_cluster))
-
-            # Handle the master flats
-            # First, loop over every filter
-            for fltr in fltrs:
-                f_clusters = plp.get_flat_clusters(binning, fltr)
-                for f_cluster in f_clusters:
-                    self.create_mflat(obs, plp, f_cluster, fltr, f_clusters.index(f_cluster))
+        # Each cluster results in its own master frame, independent of the other clusters.
+        # Only the frame types depend on each other, as darks need the master biases and
+        # flats need both. So, collect the clusters of every possible binning (and filter)...
+        bias_tasks = [(self.create_mbias, (obs, plp, b_cluster, index)) for binning in binnings 
+                      for index, b_cluster in enumerate(plp.get_bias_clusters(binning))]
+        dark_tasks = [(self.create_mdark, (obs, plp, d_cluster, index)) for binning in binnings 
+                      for index, d_cluster in enumerate(plp.get_dark_clusters(binning))]
+        flat_tasks = [(self.create_mflat, (obs, plp, f_cluster, fltr, index)) for binning in binnings 
+                      for fltr in fltrs for index, f_cluster in enumerate(plp.get_flat_clusters(binning, fltr))]
+        
+        # ...and create all frames of one type in parallel, before moving on to the next type
+        self.run_tasks(bias_tasks, "master biases")
+        self.run_tasks(dark_tasks, "master darks")
+        self.run_tasks(flat_tasks, "master flats")
         
         ps.done(f"Added source files keywords to headers")
         ps.done(f"Successfully created master correction frames!")
     
+    @staticmethod
+    def run_tasks(tasks, description):
+        """ Function that runs the passed (function, args) tasks in a pool of
+            threads. Most of the work is FITS I/O, numpy and numba kernels, which 
+            all release the GIL, so threads run in parallel without having to pickle the 
+            observation objects and master frames to other processes. The 
+            workers do not print anything themselves, as their output would 
+            get mixed up. Instead, each task returns whether it succeeded 
+            along with a status message, which is printed here.
+        """
+        if len(tasks) == 0: return
+        
+        ps.running(f"Creating {len(tasks)} {description}...")
+        
+        max_workers = max(1, (os.cpu_count() or 1) // 2)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(func, *args) for func, args in tasks]
+            
+            for future in as_completed(futures):
+                succeeded, message = future.result()
+                if succeeded: ps.done(message)
+                else: ps.warning(message)
+    
+    @staticmethod
+    def read_cluster_header(cluster):
+        """ Function that reads the header of the final frame of the passed
+            cluster, and returns it together with its binning and filter. The
+            header is read only once, as it also serves as the base for the 
+            header of the master frame.
+        """
+        header = fits.getheader(cluster[-1])
+        
+        # Same notation as the special "BINNING" keyword of get_file_info
+        if "XBINNING" in header and "YBINNING" in header:
+            binning = str(header["XBINNING"]) + "x" + str(header["YBINNING"])
+        else: binning = "?"
+        fltr = header.get("FILTER", "?")
+        
+        return header, binning, fltr
+    
     @staticmethod
     def create_mbias(obs, plp, b_cluster, index):
         """ Function that creates the master bias for a specified b_cluster for 
@@ -78,23 +119,20 @@ class Correction(Plugin):
             the final frame of this bias cluster.
         """
         # Get additional info
-        binning, fltr = plp.get_file_info(b_cluster[-1], ["BINNING", "FILTER"])
-        
-        ps.running(f"Creating {binning} Master bias for cluster {index+1}")
+        header, binning, fltr = Correction.read_cluster_header(b_cluster)
 
         # Generate the master bias
         mbias = plp.create_master_bias(b_cluster)
 
         # Add source files to the header
-        header = fits.getheader(b_cluster[-1])
         header = BlaauwPipe.header_add_source(header, b_cluster)
 
         # Save the master bias and the updated header
-        filename = "master_bias" + binning + "C" + str(index+1) + ".fits"
+        filename = cst.mbias_filename.format(binning=binning, index=index+1)
         savepath = os.path.join(plp.cor_dir, filename)
         BlaauwPipe.save_fits(savepath, data=mbias, header=header)
             
-        ps.updateDone(f"{binning} Master bias saved at {BlaauwPipe.strip_filepath(savepath)}")
+        return True, f"{binning} Master bias saved at {BlaauwPipe.strip_filepath(savepath)}"
     
     @staticmethod
     def create_mdark(obs, plp, d_cluster, index, max_days_off=365):
@@ -109,47 +147,43 @@ class Correction(Plugin):
             max_days_off days from the current plp.working_dir.
         """
         # Get additional info
-        binning, fltr = plp.get_file_info(d_cluster[-1], ["BINNING", "FILTER"])
-        
-        ps.running(f"Creating {binning} Master dark for cluster {index+1}")
+        header, binning, fltr = Correction.read_cluster_header(d_cluster)
 
         # Find the closest master bias to the dark creation time
-        dark_creation = datetime.strptime(fits.getval(d_cluster[-1], 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f")
+        dark_creation = BlaauwPipe.parse_dateobs(header['DATE-OBS'])
         try:
             closest_mbias, mbias_path, bias_off = BlaauwPipe.get_closest_master(dark_creation, plp,
                                                                        max_days_off, binning, "master_bias")
             logging.info(f"Closest master bias (days_off={bias_off}) of size closest_mbias.shape: {mbias_path}")
         except ers.SuitableMasterMissingError as err:
-            warnings.warn(f"Master dark creation failed: {err} for {plp.working_dir}")
+            logger.warning("Master dark creation failed: %s for %s", err, plp.working_dir)
             logging.warn(f"SuitableMasterMissingError: could not find frames for dark cluster {index+1}")
 
             # Let's hope the pending log can someday fix this 
-            new_line = np.array([dark_creation.date(), "Dark file", binning, fltr, "?", "-", "-", "-", d_cluster[0]])
+            new_line = (dark_creation.date(), "Dark file", binning, fltr, "?", "-", "-", "-", d_cluster[0])
             pd.append_pending_log(new_line)
-            return
+            return False, f"{binning} Master dark for cluster {index+1} could not be created: {err}"
 
         # Generate the master dark using the found master bias
         mdark = plp.create_master_dark(d_cluster, closest_mbias)
 
         # Add source files to the header
-        header = fits.getheader(d_cluster[-1])
         header = BlaauwPipe.header_add_source(header, d_cluster)
         header = BlaauwPipe.header_add_mbias(header, mbias_path, days_off=bias_off)
 
         # Save the master dark and the updated header
-        filename = "master_dark" + binning + "C" + str(index+1) + ".fits"
+        filename = cst.mdark_filename.format(binning=binning, index=index+1)
         savepath = os.path.join(plp.cor_dir, filename)
         BlaauwPipe.save_fits(savepath, data=mdark, header=header)
         
-        ps.updateDone(f"{binning} Master dark saved at {BlaauwPipe.strip_filepath(savepath)}")
-
         # Add to the pending log if need be
         max_off = abs(bias_off)
         if max_off > 0:
-            folder_datetime = datetime.strptime(plp.working_dir.replace(cst.base_path, '').split(os.sep)[1], '%y%m%d')
-            new_line = np.array([folder_datetime.date(), "Dark file", binning, fltr, bias_off, "-", "-",
-                                 (folder_datetime + timedelta(days=max_off)).date(), savepath])
+            new_line = (plp.folder_date, "Dark file", binning, fltr, bias_off, "-", "-",
+                        plp.folder_date + timedelta(days=max_off), savepath)
             pd.append_pending_log(new_line)
+            
+        return True, f"{binning} Master dark saved at {BlaauwPipe.strip_filepath(savepath)}"
     
     @staticmethod
     def create_mflat(obs, plp, f_cluster, fltr, index, max_days_off=365):
@@ -164,12 +198,10 @@ class Correction(Plugin):
             max_days_off days from the current plp.working_dir.
         """
         # Get additional info
-        binning, fltr = plp.get_file_info(f_cluster[-1], ["BINNING", "FILTER"])
-        
-        ps.running(f"Creating {binning} Master flat of filter {fltr} for cluster {index+1}")
+        header, binning, fltr = Correction.read_cluster_header(f_cluster)
 
         # Find the closest master bias and master dark to the flat creation time
-        flat_creation = datetime.strptime(fits.getval(f_cluster[-1], 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f")
+        flat_creation = BlaauwPipe.parse_dateobs(header['DATE-OBS'])
         try:
             closest_mbias, mbias_path, bias_off = BlaauwPipe.get_closest_master(flat_creation, plp, max_days_off,
                                                                             binning, "master_bias")
@@ -179,36 +211,34 @@ class Correction(Plugin):
             logging.info(f"Closest master dark (days_off={dark_off}) of size closest_mdark.shape: {mdark_path}")
             
         except ers.SuitableMasterMissingError as err:
-            warnings.warn(f"Master flat creation failed: {err} for {plp.working_dir}")
+            logger.warning("Master flat creation failed: %s for %s", err, plp.working_dir)
             logging.warn(f"SuitableMasterMissingError: could not find frames for flat cluster {index+1} of filter {fltr}")
 
             # Let's hope the pending log can someday fix this 
-            new_line = np.array([flat_creation.date(), "Flat file", binning, fltr, "?", "?", "-", "-", f_cluster[0]])
+            new_line = (flat_creation.date(), "Flat file", binning, fltr, "?", "?", "-", "-", f_cluster[0])
             pd.append_pending_log(new_line)
-            return
+            return False, f"{binning} Master flat of filter {fltr} for cluster {index+1} could not be created: {err}"
 
         # Generate the master flat using the found master bias and master dark
         mflat = plp.create_master_flats(f_cluster, [fltr], closest_mbias, closest_mdark)
         # Add source files to the header
-        header = fits.getheader(f_cluster[-1])
         header = BlaauwPipe.header_add_source(header, f_cluster)
         header = BlaauwPipe.header_add_mbias(header, mbias_path, days_off=bias_off)
         header = BlaauwPipe.header_add_mdark(header, mdark_path, days_off=dark_off)
 
         # Save the master flat and the updated header
-        filename = "master_flat" + binning + fltr + "C" + str(index+1) + ".fits"
+        filename = cst.mflat_filename.format(binning=binning, fltr=fltr, index=index+1)
         savepath = os.path.join(plp.cor_dir, filename)
         BlaauwPipe.save_fits(savepath, data=mflat, header=header)
         
-        ps.updateDone(f"{binning} Master flat of filter {fltr} saved at {BlaauwPipe.strip_filepath(savepath)}")
-
         # Add to the pending log if need be
         max_off = abs(max(bias_off, dark_off))
         if max_off > 0:
-            folder_datetime = datetime.strptime(plp.working_dir.replace(cst.base_path, '').split(os.sep)[1], '%y%m%d')
-            new_line = np.array([folder_datetime.date(), "Flat file", binning, fltr, bias_off, dark_off, "-", 
-                                 (folder_datetime + timedelta(days=max_off)).date(), savepath])
+            new_line = (plp.folder_date, "Flat file", binning, fltr, bias_off, dark_off, "-", 
+                        plp.folder_date + timedelta(days=max_off), savepath)
             pd.append_pending_log(new_line)
+            
+        return True, f"{binning} Master flat of filter {fltr} saved at {BlaauwPipe.strip_filepath(savepath)}"
     
     @staticmethod
     def recreate_mdark(obs, plp, file_path, binning, fltr):
@@ -217,13 +247,15 @@ class Correction(Plugin):
         """
         # Re-initialise basic information
         cor_dir, filename = os.path.split(file_path)
-        filename = filename.split(".")[0]
-        cluster = filename.replace("master_dark", "").replace(binning, "")
-        cluster_index = int(cluster.replace("C", "")) - 1
+        match = mdark_pattern.fullmatch(filename)
+        if match is None:
+            logger.warning("Cannot recreate %s: no cluster index in its filename", file_path)
+            return
+        cluster_index = int(match.group("index")) - 1
 
         # Handle the master dark
         d_clusters = plp.get_dark_clusters(binning)
-        create_mdark(obs, plp.working_dir, args, d_clusters[cluster_index], cluster_index)
+        return Correction.create_mdark(obs, plp, d_clusters[cluster_index], cluster_index)
     
     @staticmethod
     def recreate_mflat(obs, plp, file_path, binning, fltr):
@@ -232,10 +264,12 @@ class Correction(Plugin):
         """
         # Re-initialise basic information
         cor_dir, filename = os.path.split(file_path)
-        filename = filename.split(".")[0]
-        cluster = filename.replace("master_dark", "").replace(binning, "").replace(fltr, "")
-        cluster_index = int(cluster.replace("C", "")) - 1
+        match = mflat_pattern.fullmatch(filename)
+        if match is None:
+            logger.warning("Cannot recreate %s: no cluster index in its filename", file_path)
+            return
+        cluster_index = int(match.group("index")) - 1
 
         f_clusters = plp.get_flat_clusters(binning, fltr)
-        create_mflat(obs, plp.working_dir, args, f_clusters[cluster_index], fltr, cluster_index)
+        return Correction.create_mflat(obs, plp, f_clusters[cluster_index], fltr, cluster_index)
         
\ No newline at end of file
@@ -0,0 +1,92 @@
+import numpy as np
+
+# numba compiles the kernels below into single loops, and the 
+# pipeline falls back on plain numpy when it is not installed
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Without numba, numexpr can still evaluate an expression in a single 
+# pass (in cache-sized blocks), instead of one pass per operation
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+def median_corrected(frames, bias, dark, scales, norms):
+    """ Function that corrects each of the stacked frames and returns their
+        median, i.e. the median along axis 0 of
+            (frames[i] - bias - dark * scales[i]) / norms[i]
+        With numba, every pixel is read, corrected and combined in one pass,
+        instead of making a full pass over the stack for every operation.
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    scales = np.asarray(scales, dtype=np.float64)
+    norms = np.asarray(norms, dtype=np.float64)
+
+    if njit is not None:
+        out = np.empty(frames.shape[1:])
+        median_corrected_kernel(frames, np.asarray(bias, dtype=np.float64),
+                                np.asarray(dark, dtype=np.float64), scales, norms, out)
+        return out
+
+    corrected = (frames - bias - dark * scales[:, None, None]) / norms[:, None, None]
+    return np.median(corrected, axis=0)
+
+def reduce_light(data, bias, dark, flat, exptime):
+    """ Function that reduces a light frame with the passed master frames,
+        i.e. returns (data - bias - dark * exptime) / flat in float32.
+        With numba, every pixel of the data and the three masters is read
+        once, in a single pass, and numexpr does the same without numba. 
+        Otherwise the steps are done in place on a single output array, 
+        which still avoids any temporary frames.
+    """
+    out = np.empty(np.shape(data), dtype=np.float32)
+    if njit is not None:
+        reduce_light_kernel(np.asarray(data, dtype=np.float32).reshape(-1), np.asarray(bias, dtype=np.float32).reshape(-1),
+                            np.asarray(dark, dtype=np.float32).reshape(-1), np.asarray(flat, dtype=np.float32).reshape(-1),
+                            np.float32(exptime), out.reshape(-1))
+        return out
+    
+    if ne is not None:
+        variables = {"data": np.asarray(data, dtype=np.float32), "bias": np.asarray(bias, dtype=np.float32),
+                     "dark": np.asarray(dark, dtype=np.float32), "flat": np.asarray(flat, dtype=np.float32),
+                     "exptime": np.float32(exptime)}
+        ne.evaluate("(data - dark * exptime - bias) / flat", local_dict=variables, out=out)
+        return out
+    
+    np.multiply(dark, exptime, out=out)
+    np.subtract(data, out, out=out)
+    np.subtract(out, bias, out=out)
+    np.divide(out, flat, out=out)
+    return out
+
+if njit is not None:
+    # nogil=True, as the light frames are reduced in a pool of threads
+    @njit(cache=True, nogil=True)
+    def reduce_light_kernel(data, bias, dark, flat, exptime, out):
+        for i in range(data.size):
+            out[i] = (data[i] - dark[i] * exptime - bias[i]) / flat[i]
+
+if njit is not None:
+    # Not parallel=True: the master frames are already created in a pool of threads,
+    # and numba's parallel kernels hang the interpreter when launched from them.
+    # Instead nogil=True, as the kernel touches no Python objects, so those threads
+    # really run their kernels at the same time
+    @njit(cache=True, nogil=True)
+    def median_corrected_kernel(frames, bias, dark, scales, norms, out):
+        # One buffer is reused for the stack of every pixel
+        n, height, width = frames.shape
+        values = np.empty(n)
+        for y in range(height):
+            for x in range(width):
+                for i in range(n):
+                    values[i] = (frames[i, y, x] - bias[y, x] - dark[y, x] * scales[i]) / norms[i]
+
+                # The stacks are small, so just sort them to find the median
+                values.sort()
+                if n % 2 == 1:
+                    out[y, x] = values[n // 2]
+                else:
+                    out[y, x] = 0.5 * (values[n // 2 - 1] + values[n // 2])
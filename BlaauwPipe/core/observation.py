@@ -1,11 +1,36 @@
 from astropy.io import fits
+from contextlib import ExitStack
 from datetime import datetime
 import errno
+from functools import lru_cache
 import numpy as np
-from os import listdir
+from os import scandir
+import re
 from os.path import isfile, join, getmtime, exists
 import warnings
 
+from core.kernels import median_corrected
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+# The header keywords that are stored in the observation index, keyed 
+# on the name of their dataset in the HDF5 sidecar file
+index_columns = {"frame_type": "IMAGETYP", "binning": "BINNING", "filter": "FILTER", 
+                 "dateobs": "DATE-OBS", "exptime": "EXPTIME"}
+
 class Observation(object):
     """
     This class provides a convenient way to access, view and manipulate the data of an observation
@@ -35,7 +60,7 @@ class Observation(object):
     Updated on 24-12-2020
     """
     
-    def __init__(self, foldername):
+    def __init__(self, foldername, index_path=None):
         """
         Initialize an Observation object. One can either pass the data directory path or a file in 
         this same directory (for example: a .fits file). Raises an error whenever the system 
@@ -44,6 +69,10 @@ class Observation(object):
         Args:
             foldername (string): the (file- or) foldername the Observation object is built around.
             
+        Keyword Args:
+            index_path (string): path to an HDF5 file in which the scanned header values are stored,
+                                 so that later runs on the same folder can skip the header scan.
+            
         Raises:
             FileNotFoundError: the given folder could not be found.
             
@@ -60,6 +89,10 @@ class Observation(object):
             
         # Prime the newly created object with some attributes
         self.foldername = foldername
+        self.index_path = index_path
+        self.file_info = {}
+        self.file_stats = {}
+        self.cluster_cache = {}
         
         self.group_raw_content()  # Group all the content of the folder
             
@@ -87,7 +120,7 @@ class Observation(object):
         
         for file in self.files:
             # If the total list of resulting values matches the requested values, add it to the results
-            if self.get_file_info(file, keywords) == list(values):
+            if self.get_indexed_info(file, keywords) == list(values):
                 result.append(file)
             
         return result
@@ -98,8 +131,8 @@ class Observation(object):
         their respective list based on their image type. Besides, it keeps track of all the 
         different filters it comes across.
         """
-        # These keywords are needed for categorising
-        keywords = ["IMAGETYP", "EXPTIME", "FILTER"]
+        # These keywords are needed for categorising, and are read in one go
+        keywords = list(index_columns.values())
         
         # Lists containing the designated files. In the end, these become object attributes
         lightFiles = []
@@ -107,16 +140,37 @@ class Observation(object):
         darkFiles = []
         flatFiles = []
 
-        # Get the (valid!) files in the given folder, so either .fits or .fit
-        folderContent = [join(self.foldername, file) for file in listdir(self.foldername)
-                         if (isfile(join(self.foldername, file)) and (file.endswith(".fits") or file.endswith(".FIT")))]
-
-        # Sort the content on modification date
-        sortedContent = sorted(folderContent, key=getmtime)
+        # The clusters depend on the content, so they have to be found again
+        self.cluster_cache = {}
+        
+        # Get the (valid!) files in the given folder, sorted on modification date
+        contentStats = self.get_content_stats(self.foldername)
+        
+        # Reuse the header values of a previous run for the files that did not change since
+        index = self.load_index()
+        self.file_info = {}
+        self.file_stats = {}
+        changed = len(index) != len(contentStats)
+        for filename, stats in contentStats:
+            entry = index.get(filename)
+            if entry is not None and entry[0] == stats:
+                self.file_info[filename] = entry[1]
+            else:
+                # Read all the needed header values of each new or changed file at once
+                self.file_info[filename] = dict(zip(keywords, self.get_fast_file_info(filename, keywords)))
+                changed = True
+            self.file_stats[filename] = stats
+        
+        # Only rewrite the index when files were added, changed or removed
+        if changed:
+            self.save_index()
+            
+        # The index keeps the files in the order of modification date
+        sortedContent = list(self.file_info)
         
         # Loop over each file in the data dir       
         for filename in sortedContent: 
-            imgtype, exptime, fltr = self.get_file_info(filename, keywords)
+            imgtype = self.file_info[filename]["IMAGETYP"]
 
             # The following block orders the datafiles into the specified lists
             if "Bias" in imgtype: biasFiles.append(filename)
@@ -136,6 +190,120 @@ class Observation(object):
         self.filters = filterTypes
         self.binnings = binningTypes
         
+    @staticmethod
+    def get_sorted_content(foldername):
+        """
+        Private method that returns the paths to the (valid!) files in foldername, so either .fits
+        or .FIT, sorted on modification date.
+        
+        Args:
+            foldername (string): the folder whose content should be listed
+            
+        Returns:
+            sortedContent (list of strings): the sorted paths to the files in the folder
+        """
+        return [path for path, _ in Observation.get_content_stats(foldername)]
+    
+    @staticmethod
+    def get_content_stats(foldername):
+        """
+        Private method that works like get_sorted_content, but also returns the modification time 
+        (in ns) and size of each file. A single scandir pass is used, as its entries cache the 
+        file type and the stat result needed for sorting.
+        
+        Args:
+            foldername (string): the folder whose content should be listed
+            
+        Returns:
+            contentStats (list of tuples): the sorted (path, (mtime_ns, size)) pairs of the files
+        """
+        with scandir(foldername) as entries:
+            content = [(entry.path, entry.stat()) for entry in entries
+                       if entry.is_file() and (entry.name.endswith(".fits") or entry.name.endswith(".FIT"))]
+        
+        content.sort(key=lambda item: item[1].st_mtime)
+        return [(path, (stat.st_mtime_ns, stat.st_size)) for path, stat in content]
+    
+    def load_index(self):
+        """
+        Private method that reads the header values of all files from the HDF5 file at 
+        self.index_path. Every file is stored together with its modification time and size at 
+        the moment it was read, so the caller can tell which entries are still up to date.
+        
+        Returns:
+            index (dict): maps each filepath to a ((mtime_ns, size), header values) tuple, 
+                          empty when there is no index available.
+        """
+        if h5py is None or self.index_path is None or not exists(self.index_path):
+            return {}
+        
+        with h5py.File(self.index_path, "r") as f:
+            # Indices written before the file stats were stored cannot be checked
+            if "mtime" not in f:
+                return {}
+            paths = f["path"].asstr()[:]
+            mtimes = f["mtime"][:]
+            sizes = f["size"][:]
+            columns = {keyword: [self.parse_index_value(value, kind) for value, kind 
+                                 in zip(f[column].asstr()[:], f[column + "_type"].asstr()[:])]
+                       for column, keyword in index_columns.items()}
+        
+        return {path: ((int(mtimes[i]), int(sizes[i])), {keyword: columns[keyword][i] for keyword in columns})
+                for i, path in enumerate(paths)}
+        
+    def save_index(self):
+        """
+        Private method that stores the header values in self.file_info as an HDF5 file at
+        self.index_path, with one dataset per header keyword and one row per file. Next to 
+        each keyword, the type of every value is stored so they are read back unchanged.
+        """
+        if h5py is None or self.index_path is None:
+            return
+        
+        str_dtype = h5py.string_dtype()
+        with h5py.File(self.index_path, "w") as f:
+            f.create_dataset("path", data=list(self.file_info), dtype=str_dtype)
+            f.create_dataset("mtime", data=[self.file_stats[path][0] for path in self.file_info], dtype=np.int64)
+            f.create_dataset("size", data=[self.file_stats[path][1] for path in self.file_info], dtype=np.int64)
+            for column, keyword in index_columns.items():
+                values = [info[keyword] for info in self.file_info.values()]
+                f.create_dataset(column, data=[repr(value) if not isinstance(value, str) else value 
+                                               for value in values], dtype=str_dtype)
+                f.create_dataset(column + "_type", data=[self.get_index_type(value) for value in values], 
+                                 dtype=str_dtype)
+    
+    @staticmethod
+    def get_index_type(value):
+        """
+        Private method that returns the tag under which the type of a header value is stored 
+        in the index: "b" for bools, "i" for ints, "f" for floats and "s" for everything else.
+        """
+        if isinstance(value, bool): return "b"
+        if isinstance(value, int): return "i"
+        if isinstance(value, float): return "f"
+        return "s"
+    
+    @staticmethod
+    def parse_index_value(value, kind):
+        """
+        Private method that turns a header value stored in the index back into its original 
+        type, given the tag returned by get_index_type.
+        """
+        if kind == "b": return value == "True"
+        if kind == "i": return int(value)
+        if kind == "f": return float(value)
+        return value
+    
+    def get_indexed_info(self, filename, header_keywords):
+        """
+        Private method that works like get_file_info, but takes the values from self.file_info 
+        when all of the header_keywords were indexed for this file.
+        """
+        info = self.file_info.get(filename)
+        if info is not None and all(keyword in info for keyword in header_keywords):
+            return [info[keyword] for keyword in header_keywords]
+        return self.get_file_info(filename, header_keywords)
+    
     @staticmethod
     def get_file_info(filename, header_keywords):
         """
@@ -154,34 +322,103 @@ class Observation(object):
         """
         results = []
 
-        # Open fits file and read the header from the first HDU object
-        with fits.open(filename) as hduList:
-            hdu = hduList[0]
-            hduHeader = hdu.header
-
-            # Loop over every keyword and read the correspoding value
-            for keyword in header_keywords:
-                try:
-                    # Special custom keyword "IMGSIZE" (read method docstring)
-                    if keyword == "IMGSIZE":
-                        results.append(str(hduHeader["NAXIS1"]) + "x" + str(hduHeader["NAXIS2"]))
-                    # Another special custom keyword "IMGSIZE" (read method docstring)
-                    elif keyword == "BINNING":
-                        results.append(str(hduHeader["XBINNING"]) + "x" + str(hduHeader["YBINNING"]))
-                    else:
-                        results.append(hduHeader[keyword])
-                        
-                # The keyword might not exist or be specified
-                except:
-                    results.append("?")
+        # Read the header from the first HDU object. fitsio parses it in C, so use it if installed
+        if fitsio is not None:
+            hduHeader = fitsio.read_header(filename, 0)
+        else:
+            hduHeader = fits.getheader(filename, 0)
+
+        # Loop over every keyword and read the correspoding value
+        for keyword in header_keywords:
+            try:
+                # Special custom keyword "IMGSIZE" (read method docstring)
+                if keyword == "IMGSIZE":
+                    results.append(str(hduHeader["NAXIS1"]) + "x" + str(hduHeader["NAXIS2"]))
+                # Another special custom keyword "IMGSIZE" (read method docstring)
+                elif keyword == "BINNING":
+                    results.append(str(hduHeader["XBINNING"]) + "x" + str(hduHeader["YBINNING"]))
+                else:
+                    results.append(hduHeader[keyword])
+                    
+            # The keyword might not exist or be specified
+            except:
+                results.append("?")
 
         return results
     
+    @staticmethod
+    def get_fast_file_info(filename, header_keywords):
+        """
+        Private method that works like get_file_info, but only reads and parses the first 2880 byte
+        block of the header, instead of letting astropy parse the whole header. This is enough for
+        the keywords used for categorising, which are near the top of the header. Falls back to 
+        get_file_info whenever a keyword is not found in this block or cannot be parsed.
+        
+        Args:
+            filename (string): the absolute path to the file that needs to be looked into
+            header_keywords (list of strings): the list of keywords you want to look for in the fits header
+            
+        Returns:
+            results (list): returns a list of results, whose elements can be strings or integers
+        """
+        with open(filename, "rb") as f:
+            block = f.read(2880).decode("ascii", errors="replace")
+        
+        # Every card is 80 characters long, with the keyword in the first 8
+        cards = {}
+        for i in range(0, len(block), 80):
+            card = block[i:i+80]
+            if card[8:10] == "= ":
+                cards[card[:8].rstrip()] = card[10:]
+        
+        try:
+            values = {}
+            for keyword in header_keywords:
+                # The special custom keywords are made up of two other keywords
+                if keyword == "IMGSIZE":
+                    values[keyword] = str(Observation.parse_card_value(cards["NAXIS1"])) + "x" + \
+                                      str(Observation.parse_card_value(cards["NAXIS2"]))
+                elif keyword == "BINNING":
+                    values[keyword] = str(Observation.parse_card_value(cards["XBINNING"])) + "x" + \
+                                      str(Observation.parse_card_value(cards["YBINNING"]))
+                else:
+                    values[keyword] = Observation.parse_card_value(cards[keyword])
+        
+        # Either not in the first block, or not a simple value, so let astropy handle it
+        except (KeyError, ValueError):
+            return Observation.get_file_info(filename, header_keywords)
+        
+        return [values[keyword] for keyword in header_keywords]
+    
+    @staticmethod
+    def parse_card_value(value):
+        """
+        Private method that converts the value part of a header card (everything after the "= ")
+        into a string, bool, int or float, like astropy does. Raises a ValueError for anything else.
+        """
+        value = value.strip()
+        
+        # Strings are quoted, with a literal quote written as two quotes
+        if value.startswith("'"):
+            match = re.match(r"'((?:[^']|'')*)'", value)
+            if match is None:
+                raise ValueError(value)
+            return match.group(1).replace("''", "'").rstrip()
+        
+        # Everything after the slash is a comment
+        value = value.split("/")[0].strip()
+        if value in ("T", "F"):
+            return value == "T"
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    
     def get_binnings(self, files):
         # Returns all unique binning types for light frames
         binnings = []
         for file in files:
-            cur_binning = self.get_file_info(file, ["BINNING"])[0]
+            cur_binning = self.get_indexed_info(file, ["BINNING"])[0]
             if cur_binning not in binnings:
                 binnings.append(cur_binning)
 
@@ -191,7 +428,7 @@ class Observation(object):
         # Returns all unique filter types for a given list of files
         filters = []
         for file in files:
-            cur_filter = self.get_file_info(file, ["FILTER"])[0]
+            cur_filter = self.get_indexed_info(file, ["FILTER"])[0]
             if cur_filter not in filters:
                 filters.append(cur_filter)
 
@@ -213,17 +450,15 @@ class Observation(object):
                                                the file and their creation time.
         """
         
-        # Read the creation time of the target file from the header
-        target_time_str = self.get_file_info(target, ["DATE-OBS"])[0]
-        target_time = datetime.strptime(target_time_str, '%Y-%m-%dT%H:%M:%S.%f')
+        # Read the creation time of the target file from the (indexed) header
+        target_time = self.parse_dateobs(self.get_indexed_info(target, ["DATE-OBS"])[0])
         
         # List to store tuples of the passed files: (filepath, creation_time)
         file_time_lst = []
         
         # Loop over every passed file and get their creation time
         for file in files:
-            filetime_str = self.get_file_info(file, ["DATE-OBS"])[0]
-            filetime = datetime.strptime(filetime_str, '%Y-%m-%dT%H:%M:%S.%f')
+            filetime = self.parse_dateobs(self.get_indexed_info(file, ["DATE-OBS"])[0])
             file_time_lst.append((file, filetime))
         
         # Sort this list on their difference with the target file
@@ -231,7 +466,15 @@ class Observation(object):
         return file_time_lst
     
     @staticmethod
-    def get_file_clusters(files, step=3600):
+    @lru_cache(maxsize=4096)
+    def parse_dateobs(date_obs):
+        """
+        Private method that converts a DATE-OBS string to a datetime object. strptime is relatively
+        slow and the same files are sorted over and over again, so every string is parsed only once.
+        """
+        return datetime.strptime(date_obs, "%Y-%m-%dT%H:%M:%S.%f")
+    
+    def get_file_clusters(self, files, step=3600):
         """ Function that splits the passed list of files into clusters.
             Clusters are groups of files that belong together, because 
             they were taken shortly after each other. If the creation time
@@ -242,16 +485,19 @@ class Observation(object):
             also encounter three clusters. In this case, an extra set of 
             frames was probably taken halfway through the observation.
         """    
+        # The creation time of every file, which is taken from the index of header values
+        creation_times = {file: self.parse_dateobs(self.get_indexed_info(file, ['DATE-OBS'])[0]) for file in files}
+        
         # Sort the files on creation time
-        files_sorted = sorted(files, key=lambda file: datetime.strptime(fits.getval(file, 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f"))
+        files_sorted = sorted(files, key=creation_times.get)
 
         # Track the indices where a step takes place
         step_inds = []
 
         # Loop over each file and compare the creation time to the previous
-        prev_creation = datetime.strptime(fits.getval(files[0], 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f")
+        prev_creation = creation_times[files[0]]
         for file in files_sorted:
-            creation_time = datetime.strptime(fits.getval(file, 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f")
+            creation_time = creation_times[file]
 
             # Store the current index if the time difference is high enough
             if (creation_time - prev_creation).total_seconds() > step:
@@ -291,11 +537,11 @@ class Observation(object):
             
         """
         # First, assume every file is equally large
-        binning = self.get_file_info(files[0], ["BINNING"])[0]
+        binning = self.get_indexed_info(files[0], ["BINNING"])[0]
         
         # Then loop over every file and check their sizes
         for file in files:
-            current_binning = self.get_file_info(file, ["BINNING"])[0]
+            current_binning = self.get_indexed_info(file, ["BINNING"])[0]
             
             # If it differs from the first file, there's a problem
             if current_binning != binning:
@@ -304,6 +550,27 @@ class Observation(object):
         return
     
     def get_bias_clusters(self, binning, minSize=5):
+        # Clustering reads the headers of every frame, so reuse earlier results
+        key = ("Bias", binning, minSize)
+        if key not in self.cluster_cache:
+            self.cluster_cache[key] = self.find_bias_clusters(binning, minSize)
+        return self.cluster_cache[key]
+    
+    def get_dark_clusters(self, binning, minSize=1):
+        # Clustering reads the headers of every frame, so reuse earlier results
+        key = ("Dark", binning, minSize)
+        if key not in self.cluster_cache:
+            self.cluster_cache[key] = self.find_dark_clusters(binning, minSize)
+        return self.cluster_cache[key]
+    
+    def get_flat_clusters(self, binning, fltr, minSize=1):
+        # Clustering reads the headers of every frame, so reuse earlier results
+        key = ("Flat", binning, fltr, minSize)
+        if key not in self.cluster_cache:
+            self.cluster_cache[key] = self.find_flat_clusters(binning, fltr, minSize)
+        return self.cluster_cache[key]
+    
+    def find_bias_clusters(self, binning, minSize=5):
         # Get suitable bias frames
         bias_condit = {"IMAGETYP": "Bias Frame", "BINNING": binning}
         bias_files = self.get_files(condit=bias_condit)
@@ -319,7 +586,7 @@ class Observation(object):
         
         return bias_clusters
     
-    def get_dark_clusters(self, binning, minSize=1):
+    def find_dark_clusters(self, binning, minSize=1):
         # Get suitable dark frames
         dark_condit = {"IMAGETYP": "Dark Frame", "BINNING": binning}
         dark_files = self.get_files(condit=dark_condit)
@@ -335,7 +602,7 @@ class Observation(object):
         
         return dark_clusters
     
-    def get_flat_clusters(self, binning, fltr, minSize=1):
+    def find_flat_clusters(self, binning, fltr, minSize=1):
         # Get suitable flat fields
         flat_condit = {"IMAGETYP": "Flat Field", "BINNING": binning, "FILTER": fltr}
         flat_files = self.get_files(condit=flat_condit)
@@ -351,7 +618,82 @@ class Observation(object):
         
         return flat_clusters
         
-    def create_master_bias(self, biasFiles):
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def gpu_available():
+        """
+        Private method that checks whether cupy is installed and can use a GPU. The check is done 
+        lazily, so CUDA is only initialised once frames are actually combined.
+        """
+        return cupy is not None and cupy.is_available()
+    
+    def median_combine(self, files, tile_rows=64, masterBias=None, masterDark=None, scales=None, norms=None,
+                       normalize=False):
+        """
+        Private method that median-combines the data of the passed files into a single frame. Instead 
+        of loading every frame at once, the files are combined in tiles of tile_rows rows, which are 
+        read from a memory map of each file. Only one tile of each frame is in memory at any time, which 
+        keeps the peak memory low for large clusters. Before combining, every frame i is corrected as
+        (frame - masterBias - masterDark * scales[i]) / norms[i].
+        
+        Args:
+            files (list of strings): List of the absolute path to the files that should be combined
+            
+        Keyword Args:
+            tile_rows (int): The number of rows that are combined at once
+            masterBias (numpy.ndarray): If specified, subtracted from every frame
+            masterDark (numpy.ndarray): If specified, scaled and subtracted from every frame
+            scales (list of floats): The factor with which the masterDark is scaled for each frame
+            norms (list of floats): The value by which each corrected frame is divided
+            normalize (bool): If True, norms are the medians of the whole corrected frames instead. 
+                              These are taken from the same memory maps, so the files are read once
+            
+        Returns:
+            combined (numpy.ndarray): returns the median-combined frame
+            
+        """
+        scales = np.zeros(len(files)) if scales is None else np.asarray(scales, dtype=float)
+        norms = np.ones(len(files)) if norms is None else np.asarray(norms, dtype=float)
+        
+        with ExitStack() as stack:
+            # Astropy cannot memory-map the scaled (BZERO) raw data, so map the raw values and 
+            # scale them ourselves whenever rows are read
+            hdus = [stack.enter_context(fits.open(file, memmap=True, do_not_scale_image_data=True))[0] 
+                    for file in files]
+            frames = [(hdu.data, float(hdu.header.get("BSCALE", 1)), float(hdu.header.get("BZERO", 0))) for hdu in hdus]
+            height, width = frames[0][0].shape
+            combined = np.empty((height, width))
+            
+            if normalize:
+                # The median needs the whole frame, so only one frame is corrected at a time
+                bias = masterBias if masterBias is not None else 0
+                dark = masterDark if masterDark is not None else 0
+                norms = np.array([np.median(data * bscale + bzero - bias - dark * scale) 
+                                  for (data, bscale, bzero), scale in zip(frames, scales)])
+            
+            for y0 in range(0, height, tile_rows):
+                rows = slice(y0, y0 + tile_rows)
+                
+                # Only the requested rows are paged in from disk
+                stacked = np.stack([data[rows] * bscale + bzero for data, bscale, bzero in frames])
+                bias = masterBias[rows] if masterBias is not None else np.zeros(stacked.shape[1:])
+                dark = masterDark[rows] if masterDark is not None else np.zeros(stacked.shape[1:])
+                    
+                # Correct and take the median along the stacked files, on the GPU if possible
+                if self.gpu_available():
+                    stacked = cupy.asarray(stacked)
+                    corrected = (stacked - cupy.asarray(bias) - cupy.asarray(dark) * cupy.asarray(scales)[:, None, None]) \
+                                / cupy.asarray(norms)[:, None, None]
+                    combined[rows] = cupy.asnumpy(cupy.median(corrected, axis=0))
+                else:
+                    combined[rows] = median_corrected(stacked, bias, dark, scales, norms)
+            
+            # The memory maps have to be released before the files are closed
+            del hdus, frames
+                
+        return combined
+        
+    def create_master_bias(self, biasFiles, tile_rows=64):
         """
         Public method that creates the master bias matrix for all known bias files, or only for the
         list of files specified in the biasFiles argument. Returns the result and stores it in the
@@ -360,6 +702,7 @@ class Observation(object):
         Keyword Args:
             biasFiles (list of strings): List of the absolute path to files from which the master bias
                                          should be constructed
+            tile_rows (int): The number of rows that are combined at once, see median_combine
             
         Returns:
             masterBias (numpy.ndarray): returns a matrix that represents the master bias
@@ -367,36 +710,15 @@ class Observation(object):
         """
         self.check_binning(biasFiles)
         
-        stackedBiasData = None
-        
-        # Loop over each bias .fits file
-        for i in range(len(biasFiles)):
-            filename = biasFiles[i]
-
-            # Open fits file and read the header from the first HDU object
-            hduList = fits.open(filename)
-            hdu = hduList[0]
-            
-            # On the first loop, assign the hdu content to the variable
-            if stackedBiasData is None:
-                stackedBiasData = hdu.data 
-            # Afterwards, the content of each file can be stacked on axis=2
-            else:
-                stackedBiasData = np.dstack((stackedBiasData, hdu.data))
-
-        # One-dimensionalize the stacked data if needed
-        if len(biasFiles) > 1:
-            # Take the median of each row along axis=2
-            masterBias = np.median(stackedBiasData, axis=2)
-        else:
-            masterBias = stackedBiasData
+        # Take the median of the bias frames
+        masterBias = self.median_combine(biasFiles, tile_rows)
 
         # Store the master Bias for later reference
         self.masterBias = masterBias
         
         return masterBias
     
-    def create_master_dark(self, darkFiles, masterBias):
+    def create_master_dark(self, darkFiles, masterBias, tile_rows=64):
         """
         Creates the master dark matrix for all known dark files (unless darkFiles argument is passed).
         If a masterBias matrix is provided, then this one will be used in the construction of the master
@@ -408,6 +730,7 @@ class Observation(object):
                                          should be constructed
             masterBias (numpy.ndarray): If specified, the master dark will be constructed using this
                                         master bias, instead of the default self.masterBias attribute
+            tile_rows (int): The number of rows that are combined at once, see median_combine
             
         Returns:
             masterDark (numpy.ndarray): returns a matrix that represents the master dark
@@ -417,34 +740,9 @@ class Observation(object):
         self.check_binning(darkFiles)
             
         # List to keep track of the exposure times of each dark frame
-        EXPTIMEs = np.zeros(len(darkFiles))
+        EXPTIMEs = np.array([self.get_indexed_info(file, ["EXPTIME"])[0] for file in darkFiles], dtype=float)
         tolerance = 30  # Defines how large the biggest difference in exposure times should be
 
-        stackedDarkData = None
-
-        # Loop over each dark .fits file
-        for i in range(len(darkFiles)):
-            filename = darkFiles[i]
-
-            # Open fits file and read the header from the first HDU object
-            hduList = fits.open(filename)
-            hdu = hduList[0]
-            hduHeader = hdu.header
-
-            # This block reads the EXPTIME keyword from the header and stores it in a list
-            EXPTIME = hduHeader["EXPTIME"]
-            EXPTIMEs[i] = EXPTIME
-            
-            # Subtract the masterBias frame
-            darkBiasCorrected = hdu.data - masterBias 
-
-            # On the first loop, assign the hdu content to the variable
-            if stackedDarkData is None:
-                stackedDarkData = darkBiasCorrected 
-            # Afterwards, the content of each file can be stacked on axis=2
-            else:
-                stackedDarkData = np.dstack((stackedDarkData,darkBiasCorrected))
-
         # For the best results, all exposure times should more or less be the same, so check that
         avgEXPTIME = EXPTIMEs.mean()
         largestDiff = EXPTIMEs.max() - EXPTIMEs.min()
@@ -453,12 +751,8 @@ class Observation(object):
         if largestDiff > tolerance:
             warnings.warn(f"The exposure time difference between dark frames is large: {largestDiff}s!")
             
-        # One-dimensionalize the stacked data if needed
-        if len(darkFiles) > 1:
-            # Take the median of each row along axis=2
-            masterDarkUnnorm = np.median(stackedDarkData, axis=2)
-        else:
-            masterDarkUnnorm = stackedDarkData
+        # Take the median of the bias-subtracted dark frames
+        masterDarkUnnorm = self.median_combine(darkFiles, tile_rows, masterBias=masterBias)
 
         # Normalize the frame by dividing by the average exposure time
         masterDark = masterDarkUnnorm / avgEXPTIME
@@ -468,7 +762,7 @@ class Observation(object):
 
         return masterDark
     
-    def create_master_flats(self, flatFiles, filterTypes, masterDark, masterBias):
+    def create_master_flats(self, flatFiles, filterTypes, masterDark, masterBias, tile_rows=64):
         """
         Creates the master flat field matrices for all known flat files (unless flatFiles argument is
         passed) for all the known filters (unless filterTypes argument is passed). Uses the passed masterBias or
@@ -485,6 +779,7 @@ class Observation(object):
                                         master dark, instead of the default self.masterDark attribute
             masterBias (numpy.ndarray): If specified, the master flats will be constructed using this
                                         master bias, instead of the default self.masterBias attribute
+            tile_rows (int): The number of rows that are combined at once, see median_combine
             
         Returns:
             masterFlat (list of numpy.ndarray): returns a 3D matrix that represents the master flats.
@@ -494,8 +789,6 @@ class Observation(object):
         """
         self.check_binning(flatFiles)
         
-        length, width = masterBias.shape
-        
         # Variable that stores the master Flat for each filter type
         masterFlats = None
 
@@ -503,46 +796,15 @@ class Observation(object):
         for f in range(len(filterTypes)):
             filterType = filterTypes[f]
 
-            stackedFlatData = None
+            # Only use the files with the filter we're currently interested in
+            filterFiles = [file for file in flatFiles if self.get_indexed_info(file, ["FILTER"])[0] == filterType]
+            EXPTIMEs = [self.get_indexed_info(file, ["EXPTIME"])[0] for file in filterFiles]
             
-            # Loop over each flat .fits file
-            for i in range(len(flatFiles)):
-                filename = flatFiles[i]
-
-                # Open fits file and read the header from the first HDU object
-                hduList = fits.open(filename)
-                hdu = hduList[0]
-                hduHeader = hdu.header
-
-                # Check whether the data uses the same filter as we're currently interested in
-                FILTER = hduHeader["FILTER"]
-                if FILTER != filterType: continue  # If not, we continue to the next file
-
-                # This block reads the EXPTIME keyword from the header
-                EXPTIME = hduHeader["EXPTIME"]
-                masterDarkScaled = masterDark * EXPTIME  # Scale the masterDark to the current exposure time
-                
-                # Correct the frame by subtracting bias and dark currents
-#                 print(hdu.data.shape, masterBias.shape, masterDarkScaled.shape)
-                flatBiasDarkCorrected = hdu.data - masterBias - masterDarkScaled
-
-                # Normalize the frame by dividing by the median value
-                frameMedian = np.median(flatBiasDarkCorrected)
-                flatNormalized = flatBiasDarkCorrected / frameMedian
-
-                # On the first loop, assign the hdu content to the variable
-                if stackedFlatData is None:
-                    stackedFlatData = flatNormalized 
-                # Afterwards, the content of each file can be stacked on axis=2
-                else:
-                    stackedFlatData = np.dstack((stackedFlatData, flatNormalized))
-
-            # One-dimensionalize the stacked data if needed
-            if len(flatFiles) > 1:
-                # Gives the masterFlat for the current filter as the median
-                masterFlat = np.median(stackedFlatData, axis=2)
-            else:
-                masterFlat = stackedFlatData
+            # Correct each frame by subtracting bias and dark currents, normalize it by the median 
+            # of the whole corrected frame, then take the median. The masterDark is scaled to 
+            # the exposure time of each frame
+            masterFlat = self.median_combine(filterFiles, tile_rows, masterBias=masterBias, masterDark=masterDark,
+                                             scales=EXPTIMEs, normalize=True)
                 
             #  Replace 0-values with something very small: 1e-100
             masterFlat = np.where(masterFlat==0, 1e-100, masterFlat)
@@ -1,90 +1,133 @@
 from core.observation import Observation
 
 from datetime import datetime
+from functools import lru_cache
 import os
-import numpy as np
 import csv
+import threading
 
 import core.constants as cst
 import core.correction as cor
 import core.reduction as red
 
+from blaauwpipe import BlaauwPipe
+
+# Whether this process already made sure the pending log has a header
+pending_ready = False
+pending_lock = threading.Lock()
+
+def init_pending_log():
+    global pending_ready
+    with pending_lock:
+        if pending_ready: return
+        # Create the pending log with a header if it doesn't exist. O_EXCL makes the 
+        # creation atomic, so only one of several concurrent workers writes the header
+        clmns = ["Date", "Frame type", "Binning", "Filter", "BIAS-AGE", "DARK-AGE", "FLAT-AGE", "Expires", "Path"]
+        try:
+            fd = os.open(cst.pending_log, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            with open(fd, "w", newline="") as f:
+                csv.writer(f).writerow(clmns)
+        except FileExistsError: pass
+        pending_ready = True
+
 def append_pending_log(new_line):
     pd_log = cst.pending_log
-    # Create the pending log if it doesn't exist
-    if not os.path.exists(pd_log):
-        # Append a header
-        clmns = np.array(["Date", "Frame type", "Binning", "Filter", "BIAS-AGE", "DARK-AGE", "FLAT-AGE", "Expires", "Path"])
-        np.savetxt(pd_log, clmns.reshape(1, clmns.shape[0]), delimiter=", ", fmt="%s")
+    # Only the first call per process checks for the header
+    if not pending_ready:
+        init_pending_log()
     # Append the new line to the pending log
-    with open(pd_log, "ab") as f:
-        np.savetxt(f, new_line.reshape(1, new_line.shape[0]), delimiter=", ", fmt="%s")
+    with open(pd_log, "a", newline="") as f:
+        csv.writer(f).writerow(new_line)
         
 def read_pending_log():
     pd_log = cst.pending_log
-    lines = []
-    # Loop over each line and append its content to the list
-    with open(pd_log, "r") as f:
-        reader = csv.reader(f, delimiter=",")
-        for i, line in enumerate(reader):
-            lines.append(line)
+    # Read every line at once, skipinitialspace strips the spaces after each delimiter
+    with open(pd_log, "r", newline="") as f:
+        lines = list(csv.reader(f, delimiter=",", skipinitialspace=True))
 
     # Note that the first element is the header! This line is purposefully returned
     return lines
 
+@lru_cache(maxsize=None)
+def parse_expiry(expiry):
+    # Many lines share the same expiry date, so only parse each date once.
+    # Raises a ValueError when the line has no expiry date, i.e. "-"
+    return datetime.strptime(expiry, "%d-%m-%Y")
+
+def rerun_light(line_obs, line_working_dir, args, line):
+    date, frame_type, binning, fltr, bias_off, dark_off, flat_off, expiry, file_path = line
+    max_days_off = 365
+    # Cut on calculation time if possible
+    try:
+        max_days_off = abs(max(int(bias_off), int(dark_off), int(flat_off)))
+    except ValueError: pass
+    # Re-reduce light file. Will add a new entry in the pending log, but hopefully with a
+    # lower max_days_off. When the time's there, it will expire.
+    red.reduce_img(line_obs, line_working_dir, args, file_path, max_days_off)
+
+def rerun_dark(line_obs, line_working_dir, args, line):
+    date, frame_type, binning, fltr, bias_off, dark_off, flat_off, expiry, file_path = line
+    line_working_dir = (os.path.split(os.path.split(file_path)[0])[0]).replace(cst.tele_path, cst.base_path)
+    cor.recreate_mdark(line_obs, line_working_dir, args, file_path, binning, fltr)
+
+def rerun_flat(line_obs, line_working_dir, args, line):
+    date, frame_type, binning, fltr, bias_off, dark_off, flat_off, expiry, file_path = line
+    line_working_dir = (os.path.split(os.path.split(file_path)[0])[0]).replace(cst.tele_path, cst.base_path)
+    cor.recreate_mflat(line_obs, line_working_dir, args, file_path, binning, fltr)
+
+# The function that re-runs a line of the pending log, for each frame type. 
+# New frame types can be supported by adding them here
+rerun_functions = {
+    "Light file": rerun_light,
+    "Dark file": rerun_dark,
+    "Flat file": rerun_flat,
+}
+
 def rerun_pending(obs, working_dir, args):
     pd_log = cst.pending_log
     
     # Read the current pending log
-    lines = np.array(read_pending_log())
+    lines = read_pending_log()
     folder_date = working_dir.replace(cst.base_path, '').split(os.sep)[1]
-    folder_datetime = datetime.strptime(folder_date, '%y%m%d')
+    folder_datetime = BlaauwPipe.parse_folder_date(folder_date)
     
     if len(lines) == 0:
         ut.Print("Pending log empty!", args, True)
         return
     
+    header, *rows = lines
+    
     # Overwrite the pending log
-    with open(pd_log, "wb") as f:
+    with open(pd_log, "w", newline="") as f:
         # Re-append the header
-        np.savetxt(f, lines[0].reshape(1, lines[0].shape[0]), delimiter=",", fmt="%s")
+        csv.writer(f).writerow(header)
+    
+    # Many lines point to files in the same folder, so only create 
+    # one observation object per folder and reuse it for every line
+    line_observations = {}
     
     # Loop over every old line and check if it needs to be re-run 
-    for line in lines[1:]:
-        line = np.array([entry.strip() for entry in line])
+    for line in rows:
         # Unpack data and rerun the reduction process
         date, frame_type, binning, fltr, bias_off, dark_off, flat_off, expiry, file_path = line
         
         # Reinitialise the observation object and working dir
-        line_obs = Observation(file_path)
+        line_folder = os.path.split(file_path)[0]
+        if line_folder not in line_observations:
+            line_observations[line_folder] = Observation(line_folder)
+        line_obs = line_observations[line_folder]
         line_working_dir = (os.path.split(file_path)[0]).replace(cst.tele_path, cst.base_path)
         tele_data_dir = line_working_dir.replace(cst.base_path, cst.tele_path)
         
         # Check its expiry date if is has one
         try:
-            expiry_date = datetime.strptime(line[-2], "%d-%m-%Y")
+            expiry_date = parse_expiry(line[-2])
             if expiry_date.date() < folder_datetime.date():
                 # We cannot hope to find a better version, ever. So, we can 
                 # safely continue with new actions/plugins.
                 run_plugins_single(line_obs, line_working_dir, args, file, "pending")
         except ValueError: pass
         
-        # Re-reduce a light file
-        if frame_type == "Light file":
-            max_days_off = 365
-            # Cut on calculation time if possible
-            try:
-                max_days_off = abs(max(int(bias_off), int(dark_off), int(flat_off)))
-            except ValueError: pass
-            # Re-reduce light file. Will add a new entry in the pending log, but hopefully with a
-            # lower max_days_off. When the time's there, it will expire.
-            red.reduce_img(line_obs, line_working_dir, args, file_path, max_days_off)
-        
-        # Re-reduce dark frame
-        elif frame_type == "Dark file":
-            line_working_dir = (os.path.split(os.path.split(file_path)[0])[0]).replace(cst.tele_path, cst.base_path)
-            cor.recreate_mdark(line_obs, line_working_dir, args, file_path, binning, fltr)
-        # Re-reduce flat field
-        elif frame_type == "Flat file":
-            line_working_dir = (os.path.split(os.path.split(file_path)[0])[0]).replace(cst.tele_path, cst.base_path)
-            cor.recreate_mflat(line_obs, line_working_dir, args, file_path, binning, fltr)
\ No newline at end of file
+        # Re-reduce the light file, or re-create the master dark or flat
+        if frame_type in rerun_functions:
+            rerun_functions[frame_type](line_obs, line_working_dir, args, line)
\ No newline at end of file
@@ -2,8 +2,9 @@ import core.constants as cst
 from core.observation import Observation
 
 from astropy.io import fits
-from os import listdir
-from os.path import isfile, join, getmtime, exists
+from datetime import datetime
+from os import sep
+from os.path import isfile, join, exists
 
 class PipelineProduct(Observation):
     
@@ -14,6 +15,11 @@ class PipelineProduct(Observation):
         self.red_dir = join(self.working_dir, cst.reduced_dir)
         
         super().__init__(foldername)
+        
+        # The date of this observation's date folder, e.g. 210319. This is fixed 
+        # for a plp, so it is parsed only once instead of for every cluster
+        self.folder_date = datetime.strptime(self.working_dir.replace(cst.base_path, '').split(sep)[1], '%y%m%d').date()
+        
         self.group_correction_content()
         self.group_reduced_content()
         self.get_logfile()
@@ -29,6 +35,9 @@ class PipelineProduct(Observation):
         different filters it comes across.
         """
         if not exists(self.raw_dir): return
+        
+        # The clusters depend on the content, so they have to be found again
+        self.cluster_cache = {}
             
         # These keywords are needed for categorising
         keywords = ["IMAGETYP", "EXPTIME", "FILTER"]
@@ -39,16 +48,12 @@ class PipelineProduct(Observation):
         darkFiles = []
         flatFiles = []       
         
-        # Get the (valid!) files in the given folder, so either .fits or .fit
-        folderContent = [join(self.raw_dir, file) for file in listdir(self.raw_dir)
-                         if (isfile(join(self.raw_dir, file)) and (file.endswith(".fits") or file.endswith(".FIT")))]
-
-        # Sort the content on modification date
-        sortedContent = sorted(folderContent, key=getmtime)
+        # Get the (valid!) files in the given folder, sorted on modification date
+        sortedContent = self.get_sorted_content(self.raw_dir)
         
         # Loop over each file in the data dir       
         for filename in sortedContent: 
-            imgtype, exptime, fltr = super().get_file_info(filename, keywords)
+            imgtype, exptime, fltr = super().get_fast_file_info(filename, keywords)
 
             # The following block orders the datafiles into the specified lists
             if "Bias" in imgtype: biasFiles.append(filename)
@@ -79,16 +84,12 @@ class PipelineProduct(Observation):
         masterDarks = []
         masterFlats = []       
         
-        # Get the (valid!) files in the given folder, so either .fits or .fit
-        folderContent = [join(self.cor_dir, file) for file in listdir(self.cor_dir)
-                         if (isfile(join(self.cor_dir, file)) and (file.endswith(".fits") or file.endswith(".FIT")))]
-
-        # Sort the content on modification date
-        sortedContent = sorted(folderContent, key=getmtime)
+        # Get the (valid!) files in the given folder, sorted on modification date
+        sortedContent = self.get_sorted_content(self.cor_dir)
         
         # Loop over each file in the data dir       
         for filename in sortedContent: 
-            imgtype, exptime, fltr = super().get_file_info(filename, keywords)
+            imgtype, exptime, fltr = super().get_fast_file_info(filename, keywords)
 
             # The following block orders the datafiles into the specified lists
             if "Bias" in imgtype: masterBiases.append(filename)
@@ -111,12 +112,8 @@ class PipelineProduct(Observation):
         # These keywords are needed for categorising
         keywords = ["IMAGETYP", "EXPTIME", "FILTER"]
         
-        # Get the (valid!) files in the given folder, so either .fits or .fit
-        folderContent = [join(self.red_dir, file) for file in listdir(self.red_dir)
-                         if (isfile(join(self.red_dir, file)) and (file.endswith(".fits") or file.endswith(".FIT")))]
-
-        # Sort the content on modification date
-        sortedContent = sorted(folderContent, key=getmtime)
+        # Get the (valid!) files in the given folder, sorted on modification date
+        sortedContent = self.get_sorted_content(self.red_dir)
                 
         filterTypes = super().get_filters(sortedContent)
         binningTypes = super().get_binnings(sortedContent)
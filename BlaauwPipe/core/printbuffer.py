@@ -0,0 +1,61 @@
+from io import StringIO
+import sys
+import threading
+import time
+
+class PrintBuffer(object):
+    """ Context manager that temporarily replaces sys.stdout by a buffer.
+        Everything that is written to stdout is collected, and only passed
+        on to the real stdout once flush_interval seconds have passed since
+        the last write to it, or once more than max_size characters are
+        waiting. This saves a write (and flush) to the terminal for every
+        single status update in loops that print a lot, e.g. progress bars.
+        Whatever is left in the buffer is written when the context exits.
+    """
+
+    def __init__(self, flush_interval=0.1, max_size=64*1024):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.buffer = StringIO()
+        self.lock = threading.RLock()
+        self.last_flush = time.monotonic()
+        self.stdout = None
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.stdout = self.stdout
+        self.flush_buffer()
+
+    def write(self, s):
+        with self.lock:
+            self.buffer.write(s)
+            if self.buffer.tell() > self.max_size or time.monotonic() - self.last_flush > self.flush_interval:
+                self.flush_buffer()
+        return len(s)
+
+    def flush(self):
+        # Explicit flushes are postponed until the interval has passed as well,
+        # otherwise every status update would still reach the terminal at once
+        with self.lock:
+            if time.monotonic() - self.last_flush > self.flush_interval:
+                self.flush_buffer()
+
+    def flush_buffer(self):
+        """ Function that writes the buffered content to the real stdout. """
+        with self.lock:
+            self.stdout.write(self.buffer.getvalue())
+            self.stdout.flush()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            self.last_flush = time.monotonic()
+
+    def isatty(self):
+        return self.stdout.isatty()
+
+    def __getattr__(self, name):
+        # Anything else, like the encoding, is that of the real stdout
+        return getattr(self.stdout, name)
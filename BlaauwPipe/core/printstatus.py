@@ -18,11 +18,60 @@
 # # ==============================================================================
 
 import sys
+import time
 from datetime import datetime
 
 import logging
 logger = logging.getLogger(__name__)
 
+# The status messages are logged with stacklevel=2, because the log format of the pipeline
+# includes the module and funcName of the record. With stacklevel=2, these name the function 
+# that called the helper, instead of the helper in this file itself. Only progressBar, 
+# which is called for every iteration of a loop, logs without it.
+
+# Every message is written to stdout at once, and only flushed right away on a terminal
+stdout_tty = sys.stdout.isatty()
+
+def esc(sequence):
+    """
+    Return the passed escape sequence if stdout is a terminal. In a pipe or a file, colours 
+    and cursor movements are just noise, so an empty string is returned instead.
+    """
+    return sequence if stdout_tty else ""
+
+# The coloured tags of the status messages. A single SGR code sets the foreground colour 
+# and \033[39m resets only that, as nothing else needs to be reset
+tag_running = esc('\033[37m') + 'RUNNING ' + esc('\033[39m')
+tag_done    = esc('\033[32m') + 'DONE    ' + esc('\033[39m')
+tag_warning = esc('\033[33m') + 'WARNING ' + esc('\033[39m')
+tag_failed  = esc('\033[31m') + 'FAILED  ' + esc('\033[39m')
+
+# Cursor movements to overwrite the previous line, or to write over the current one
+line_start  = esc('\r')
+line_up     = esc('\033[F\033[K')
+line_clear  = esc('\033[K')
+
+# Background colours of the progress bar, and enough spaces to slice the bar from
+bar_colors = {'y': '\033[43m', 'k': '\033[40m', 'r': '\033[41m', 'g': '\033[42m', 
+              'b': '\033[44m', 'm': '\033[45m', 'c': '\033[46m'}
+bar_spaces = ' ' * 512
+
+# What the last drawn progress bar showed, to skip redrawing the exact same bar
+last_progress = [None]
+
+# The last formatted timestamp, together with the monotonic time at which it was made
+timestamp_cache = [-1.0, ""]
+
+def timestamp():
+    """
+    Return the current time of day as HH:MM:SS.mmm. Status messages come in bursts, so the 
+    formatted string is reused for up to 50 ms instead of formatting a new one every call.
+    """
+    t = time.monotonic()
+    if t - timestamp_cache[0] > 0.05:
+        timestamp_cache[:] = [t, datetime.now().isoformat(sep=' ', timespec='milliseconds')[11:]]
+    return timestamp_cache[1]
+
 def progressBar(iteration, total, prefix='', suffix='', decimals=2, barLength=80, color='g', log=True):
     """
     Call in a loop to create a progress bar in the terminal.
@@ -36,24 +85,32 @@ def progressBar(iteration, total, prefix='', suffix='', decimals=2, barLength=80
         barLength - Optional: length of the progress bar in the terminal (int)
         color     - Optional: color identifier (str)
     """
-    if   color == 'y': color = '\033[43m'
-    elif color == 'k': color = '\033[40m'
-    elif color == 'r': color = '\033[41m'
-    elif color == 'g': color = '\033[42m'
-    elif color == 'b': color = '\033[44m'
-    elif color == 'm': color = '\033[45m'
-    elif color == 'c': color = '\033[46m'
-        
-    percents        = round(100.00 * (iteration / float(total)), decimals)
+    # Nothing would change on screen if the percentage (at two decimals), the filled
+    # length and the labels are the same as last time, so don't draw (or log) again
     filledLength    = int(round(barLength * iteration / float(total)))
-    bar             = color + ' '*filledLength + '\033[49m' + ' '*(barLength - filledLength - 1)
-    now             = datetime.now().isoformat(sep=' ', timespec='milliseconds').split(" ")[1]
-    if iteration != 0:
-        sys.stdout.write("\033[F")
-
-    sys.stdout.write(("\r{} [ ".format(now) + ('\033[0;37m'+"RUNNING "+'\033[0;39m'+"] {}\n |{}| {:.2f}{} {}\r")).format(prefix, bar, percents, '%', suffix)),
-    sys.stdout.flush()
-    if log: logging.info(prefix, stacklevel=3)
+    progress        = (int(iteration * 10000 / total), filledLength, prefix, suffix)
+    if iteration != 0 and progress == last_progress[0]: return
+    last_progress[0] = progress
+    
+    percents        = round(100.00 * (iteration / float(total)), decimals)
+    now             = timestamp()
+    
+    # Without a terminal, the bar cannot be redrawn, so just write the progress on a new line
+    if not stdout_tty:
+        sys.stdout.write(f"{now} [ {tag_running}] {prefix} {percents:.2f}% {suffix}\n")
+        if log and logger.isEnabledFor(logging.INFO): logger.info(prefix)
+        return
+    
+    color           = bar_colors.get(color, color)
+    filled          = color + bar_spaces[:filledLength] + '\033[49m' if filledLength > 0 else ''
+    bar             = filled + bar_spaces[:max(0, barLength - filledLength - 1)]
+    up              = "\033[F" if iteration != 0 else ""
+
+    sys.stdout.write(f"{up}\r{now} [ {tag_running}] {prefix}\n |{bar}| {percents:.2f}% {suffix}\r")
+    if stdout_tty: sys.stdout.flush()
+    # Called for every iteration, so skip the logging call (and its walk up 
+    # the stack to find the caller) altogether when INFO is not logged
+    if log and logger.isEnabledFor(logging.INFO): logger.info(prefix)
 
 def module(outputlabel, log=True):
     """
@@ -62,9 +119,9 @@ def module(outputlabel, log=True):
     Parameters: 
         outputlabel - Required: Message to be printed (str)
     """
-    sys.stdout.write("\033[0;37m"+outputlabel+"\033[0;39m")
-    sys.stdout.flush(); print("")
-    if log: logging.info(outputlabel, stacklevel=3)
+    sys.stdout.write(esc('\033[37m') + outputlabel + esc('\033[39m') + "\n")
+    if stdout_tty: sys.stdout.flush()
+    if log: logging.info(outputlabel, stacklevel=2)
 
 def running(outputlabel, log=True):
     """
@@ -73,10 +130,10 @@ def running(outputlabel, log=True):
     Parameters:
         outputlabel - Required: Message to be printed (str)
     """
-    now = datetime.now().isoformat(sep=' ', timespec='milliseconds').split(" ")[1]
-    sys.stdout.write("\r{} [ ".format(now)+'\033[0;37m'+"RUNNING "+'\033[0;39m'+"] " + "{:<10}".format(outputlabel))
-    sys.stdout.flush(); print("")
-    if log: logging.info(outputlabel, stacklevel=3)
+    now = timestamp()
+    sys.stdout.write(f"{line_start}{now} [ {tag_running}] {outputlabel:<10}\n")
+    if stdout_tty: sys.stdout.flush()
+    if log: logging.info(outputlabel, stacklevel=2)
 
 def updateDone(outputlabel, progressbar=False, log=True):
     """
@@ -86,13 +143,11 @@ def updateDone(outputlabel, progressbar=False, log=True):
         outputlabel - Required: Message to be printed (str)
         progressbar - Optional: Set True if the previous message was the progress bar (bool)
     """
-    if progressbar == True:
-        sys.stdout.write("\033[K")
-    now = datetime.now().isoformat(sep=' ', timespec='milliseconds').split(" ")[1]
-    sys.stdout.write("\033[F"); sys.stdout.write("\033[K")
-    sys.stdout.write("\r\r{} [ ".format(now)+'\033[0;32m'+"DONE    " + '\033[0;39m'+"] {}".format(outputlabel))
-    sys.stdout.flush(); print("")
-    if log: logging.info(outputlabel, stacklevel=3)
+    clear = line_clear if progressbar == True else ""
+    now = timestamp()
+    sys.stdout.write(f"{clear}{line_up}{line_start}{now} [ {tag_done}] {outputlabel}\n")
+    if stdout_tty: sys.stdout.flush()
+    if log: logging.info(outputlabel, stacklevel=2)
 
 def done(outputlabel, log=True):
     """
@@ -101,10 +156,10 @@ def done(outputlabel, log=True):
     Parameters: 
         outputlabel - Required: Message to be printed (str)
     """
-    now = datetime.now().isoformat(sep=' ', timespec='milliseconds').split(" ")[1]
-    sys.stdout.write("\r\r{} [ ".format(now)+'\033[0;32m'+"DONE    "+'\033[0;39m'+"] "+outputlabel)
-    sys.stdout.flush(); print("")
-    if log: logging.info(outputlabel, stacklevel=3)
+    now = timestamp()
+    sys.stdout.write(f"{line_start}{now} [ {tag_done}] {outputlabel}\n")
+    if stdout_tty: sys.stdout.flush()
+    if log: logging.info(outputlabel, stacklevel=2)
 
 def updateWarning(outputlabel, progressbar=False, log=True):
     """
@@ -114,13 +169,11 @@ def updateWarning(outputlabel, progressbar=False, log=True):
         outputlabel - Required: Message to be printed (str)
         progressbar - Optional: Set True if the previous message was the progress bar (bool)
     """
-    now = datetime.now().isoformat(sep=' ', timespec='milliseconds').split(" ")[1]
-    if progressbar == True:
-        sys.stdout.write("\033[K")
-    sys.stdout.write("\033[F"); sys.stdout.write("\033[K")
-    sys.stdout.write("\r\r{} [ ".format(now)+'\033[0;33m'+"WARNING "+'\033[0;39m'+"] "+outputlabel)
-    sys.stdout.flush(); print("")
-    if log: logging.warning(outputlabel, stacklevel=3)
+    now = timestamp()
+    clear = line_clear if progressbar == True else ""
+    sys.stdout.write(f"{clear}{line_up}{line_start}{now} [ {tag_warning}] {outputlabel}\n")
+    if stdout_tty: sys.stdout.flush()
+    if log: logging.warning(outputlabel, stacklevel=2)
 
 def warning(outputlabel, log=True):
     """
@@ -129,10 +182,10 @@ def warning(outputlabel, log=True):
     Parameters: 
         outputlabel - Required: Message to be printed (str)
     """
-    now = datetime.now().isoformat(sep=' ', timespec='milliseconds').split(" ")[1]
-    sys.stdout.write("\r\r{} [ ".format(now)+'\033[0;33m'+"WARNING "+'\033[0;39m'+"] "+outputlabel)
-    sys.stdout.flush(); print("")
-    if log: logging.warning(outputlabel, stacklevel=3)
+    now = timestamp()
+    sys.stdout.write(f"{line_start}{now} [ {tag_warning}] {outputlabel}\n")
+    if stdout_tty: sys.stdout.flush()
+    if log: logging.warning(outputlabel, stacklevel=2)
 
 def updateFailed(outputlabel, progressbar=False, log=True):
     """
@@ -142,13 +195,11 @@ def updateFailed(outputlabel, progressbar=False, log=True):
         outputlabel - Required: Message to be printed (str)
         progressbar - Optional: Set True if the previous message was the progress bar (bool)
     """
-    now = datetime.now().isoformat(sep=' ', timespec='milliseconds').split(" ")[1]
-    if progressbar == True:
-        sys.stdout.write("\033[K")
-    sys.stdout.write("\033[F"); sys.stdout.write("\033[K")
-    sys.stdout.write("\r\r{} [ ".format(now)+'\033[0;31m'+"FAILED  "+'\033[0;39m'+"] "+outputlabel)
-    sys.stdout.flush(); print("")
-    if log: logging.critical(outputlabel, stacklevel=3)
+    now = timestamp()
+    clear = line_clear if progressbar == True else ""
+    sys.stdout.write(f"{clear}{line_up}{line_start}{now} [ {tag_failed}] {outputlabel}\n")
+    if stdout_tty: sys.stdout.flush()
+    if log: logging.critical(outputlabel, stacklevel=2)
 
 def failed(outputlabel, log=True):
     """
@@ -157,10 +208,11 @@ def failed(outputlabel, log=True):
     Parameters: 
         outputlabel - Required: Message to be printed (str)
     """
-    now = datetime.now().isoformat(sep=' ', timespec='milliseconds').split(" ")[1]
-    sys.stdout.write("\r\r{} [ ".format(now)+'\033[0;31m'+"FAILED  "+'\033[0;39m'+"] "+outputlabel)
-    sys.stdout.flush(); print("")
-    if log: logging.info(critical, stacklevel=3)
+    now = timestamp()
+    sys.stdout.write(f"{line_start}{now} [ {tag_failed}] {outputlabel}\n")
+    if stdout_tty: sys.stdout.flush()
+    if log: logging.critical(outputlabel, stacklevel=2)
 
 def newline():
-    print("")
+    sys.stdout.write("\n")
+    if stdout_tty: sys.stdout.flush()
@@ -2,11 +2,18 @@ import sys
 from os import path
 from astropy.io import fits
 from astropy.io.fits.header import Header
+from functools import lru_cache
 import numpy as np
 import os
 
 from core.pluginsystem import Plugin
 
+# Location of the observatory, which is the same for every observation
+longitude = 6 + 32/60 + 11.2/3600
+latitude = 53 + 14/60 + 24.9/3600
+longitude_h = longitude/15   #longitude in decimal hours
+latitude_r = latitude *np.pi/180   #latitude in radians
+
 class Airmass(Plugin):
     """ Pipeline plugin that calculates the airmass for light files
         based on the position header keywords. After some calculations,
@@ -24,14 +31,13 @@ class Airmass(Plugin):
                            """
 
     def on_run(self, obs, working_dir, args):
-        reduce24 = np.vectorize(self.reduce24_0)
-        hourminsec2 = np.vectorize(self.hourminsec)
-        hourmin2 = np.vectorize(self.hourmin)
-    
         return
 
-    def juliandate(self, date):
-        """conversion from gregorian calendar to julian date"""
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def juliandate(date):
+        """conversion from gregorian calendar to julian date. Many files 
+        share the same date, so every date is only converted once"""
         year, month, day = date.split('-')
         year = int(year); month = int(month); day = int(day)
         if month == 1 or month == 2:
@@ -51,78 +57,76 @@ class Airmass(Plugin):
         return JD
 
     def reduce24_0(self, t):
-        """reduces a number in decimal hours into the range 0 to 24"""
-        tr = (t/24 - int(t/24))*24    #reduce GST to the range 0-24h
-        if tr <= 0:
-            tr += 24
-        return tr
+        """reduces a number (or array) in decimal hours into the range 0 to 24"""
+        tr = np.mod(t, 24.0)    #reduce GST to the range 0-24h
+        return np.where(tr <= 0, tr + 24, tr)
 
     def reduce360(self, N):
-        """reduces a number to the range 0 to 360"""
-        Nr = (N/360 - int(N/360))*360    #reduce N to the range 0-360 degrees
-        if Nr <= 0:
-            Nr += 360
-        return Nr
+        """reduces a number (or array) to the range 0 to 360"""
+        Nr = np.mod(N, 360.0)    #reduce N to the range 0-360 degrees
+        return np.where(Nr <= 0, Nr + 360, Nr)
 
     def hourminsec(self, ra):
-        """"Input is an angle in decimal hours, 
+        """"Input is an angle (or array of angles) in decimal hours, 
         output is time in hh:mm:ss."""
-        ra = reduce24(ra)
-        h = int(ra)   #hours
-        m = (ra - int(ra))*60   #minutes
-        s = (m - int(m))*60    #seconds
-        ra2 = f'{h}:{m:.0f}:{s:.2f}' 
-        return ra2
+        ra = self.reduce24_0(ra)
+        h = np.floor(ra).astype(int)   #hours
+        m = (ra - h)*60   #minutes
+        s = (m - np.floor(m))*60    #seconds
+        # Only the formatting is done per element
+        ra2 = [f'{hi}:{mi:.0f}:{si:.2f}' for hi, mi, si in zip(np.ravel(h), np.ravel(m), np.ravel(s))]
+        return ra2[0] if np.ndim(ra) == 0 else np.reshape(ra2, np.shape(ra))
 
     def hourmin(self, ra):
-        """"Input is an angle in decimal hours, 
+        """"Input is an angle (or array of angles) in decimal hours, 
         output is time in hh:mm."""
-        ra = reduce24(ra)
-        h = int(ra)   #hours
-        m = (ra - int(ra))*60   #minutes
-        ra2 = f'{h}h {m:.0f}m ' 
-        return ra2
+        ra = self.reduce24_0(ra)
+        h = np.floor(ra).astype(int)   #hours
+        m = (ra - h)*60   #minutes
+        ra2 = [f'{hi}h {mi:.0f}m ' for hi, mi in zip(np.ravel(h), np.ravel(m))]
+        return ra2[0] if np.ndim(ra) == 0 else np.reshape(ra2, np.shape(ra))
 
     def staralt(self, date, time, RA, DEC):
-        """Input are the date("dd/mm/yyyy") and the objects RA/Dec coordinates (name hh:mm:ss.ss ±dd:mm:ss.ss) and time
-        Output is the altitude and airmass at the specified *local times"""
-        year, month, day = date.split('-')
-        year = int(year); month = int(month); day = int(day)
-        hours, mnts, sec = time.split(':')
-        hours = int(hours); mnts = int(mnts); sec = float(sec)
-        time = hours + mnts/60 + sec/3600
+        """Input are the date("yyyy-mm-dd") and the objects RA/Dec coordinates (in degrees) and time (hh:mm:ss.ss),
+        either for a single observation or as arrays for many at once.
+        Output is the altitude and azimuth at the specified UT times"""
+        # Only parsing the strings is done per observation, all the math below works on whole arrays
+        dates = np.atleast_1d(date)
+        times = np.atleast_1d(time)
+        JD = np.array([self.juliandate(d) for d in dates])     # Julian date
+        time = np.array([int(hours) + int(mnts)/60 + float(sec)/3600 for hours, mnts, sec in np.char.split(times, ':')])
+        RA = np.asarray(RA, dtype=float)
+        DEC = np.asarray(DEC, dtype=float)
+        if np.ndim(date) == 0:
+            JD, time = JD[0], time[0]
+        
         RA = RA/15   #degrees to hours
 
-        long = 6 + 32/60 + 11.2/3600
-        lat = 53 + 14/60 + 24.9/3600
         #alt = 25
 
         TZ = 0  #timezone UTC +02:00
 
-        JD = juliandate(date)     # Julian date
-
         # UT to GST
         S = JD - 2451545.0
         T = S/36525.0
         T0n = 6.697374558 + (2400.051336*T) + (0.000025862*T*T)
-        T0 = reduce24(T0n)
+        T0 = self.reduce24_0(T0n)
 
         UT = time - TZ
         UTc = UT*1.002737909
         GST = T0 + UTc
-        GST = reduce24(GST)
+        GST = self.reduce24_0(GST)
 
         #GST to LST
-        longh = long/15  #longitude in decimal hours
-        LST = reduce24(GST+longh)
+        LST = self.reduce24_0(GST+longitude_h)
 
         HA = LST - RA
-        HA = reduce24(HA)  #hour angle in decimal hours
+        HA = self.reduce24_0(HA)  #hour angle in decimal hours
 
         #Equatorial to horizon coordinates
         HAr = HA*15 *np.pi/180   # hour angle in radians
         decr = DEC *np.pi/180    #declination in radians
-        latr = lat *np.pi/180   #latitude in degrees
+        latr = latitude_r
 
         altr = np.arcsin(np.sin(decr)*np.sin(latr) + np.cos(decr)*np.cos(latr)*np.cos(HAr))  # altitude in radians
         altd = altr*180/np.pi
@@ -137,53 +141,49 @@ class Airmass(Plugin):
         m = (np.cos(Z) + 0.15*(93.885 - Z)**-1.253)**-1   #airmass
         return m
 
-    def set_airmass_hdr(self, filepath):
-        """Adds airmass to header of fits file. Input is filepath of fits file"""
-        with fits.open(filepath) as hdu:
-            hdr = hdu[0].header
-            #print(hdr)
-            #del hdu[0].header['AIRMCALC']
-            imtype = hdu[0].header['IMAGETYP']
-            exptime = hdu[0].header['EXPTIME']
-            try:
-                airm_hdr = hdr['AIRMCALC']
-                print("AIRMCALC already present")
-            except:
-                try:
-                    RA = hdr['CRVAL1']
-                    DEC = hdr['CRVAL2']
-                except:
-                    RAstr = hdr['OBJCTRA']
-                    DECstr = hdr['OBJCTDEC']
-
-                    hours, mnts, sec = RAstr.split()
-                    hours = int(hours); mnts = int(mnts); sec = float(sec)
-                    RA = (hours + mnts/60 + sec/3600)*15
-
-                    deg, amnts, asec = DECstr.split()
-                    deg = int(deg); amnts = int(amnts); asec = float(asec)
-                    DEC = deg + amnts/60 + asec/3600
-
-                #print(RA, DEC)
-                Date_Time = hdr['DATE-OBS']
-                date, time = Date_Time.split('T')
-                #print(date, time)
-
-                #print(staralt(date, time, RA, DEC))
-                ALT, AZ = staralt(date, time, RA, DEC)
-                airmass_calc = airmass(ALT)
-
-                hdr.set('AIRMCALC', airmass_calc)
-
-    #             #hdu.writeto(out_root+ 'calc_airmass_'+ filename, overwrite = True)
-    #             hdu.writeto(out_root+  filename, overwrite = True)
-    #             print(filename+ ' Header Generated')
+    def get_position(self, hdr):
+        """Returns the RA and DEC (in degrees) of the header. Tries to use the 
+        Astrometry data if available, otherwise falls back on the telescope values"""
+        try:
+            RA = hdr['CRVAL1']
+            DEC = hdr['CRVAL2']
+        except KeyError:
+            RAstr = hdr['OBJCTRA']
+            DECstr = hdr['OBJCTDEC']
+
+            hours, mnts, sec = RAstr.split()
+            hours = int(hours); mnts = int(mnts); sec = float(sec)
+            RA = (hours + mnts/60 + sec/3600)*15
+
+            deg, amnts, asec = DECstr.split()
+            deg = int(deg); amnts = int(amnts); asec = float(asec)
+            DEC = deg + amnts/60 + asec/3600
+        return RA, DEC
 
     def add_airmass(self, light_files, working_dir, args):
         """ Function that calculates the airmass for all passed (light) files 
             and adds the result in the header under the keyword 'AIRMCALC'.
             Tries to use Astrometry data if available, otherwise falls 
-            back on the original telescope values.
+            back on the original telescope values. The positions and times
+            of all files are collected first, so that the airmass of every 
+            file is calculated at once with array math.
         """
+        files, ras, decs, dates, times = [], [], [], [], []
         for file in light_files:
-            set_airmass_hdr(file)
\ No newline at end of file
+            hdr = fits.getheader(file)
+            if 'AIRMCALC' in hdr:
+                print("AIRMCALC already present")
+                continue
+            RA, DEC = self.get_position(hdr)
+            date, time = hdr['DATE-OBS'].split('T')
+            files.append(file); ras.append(RA); decs.append(DEC); dates.append(date); times.append(time)
+            
+        if len(files) == 0: return
+        
+        ALT, AZ = self.staralt(dates, times, ras, decs)
+        airmass_calc = self.airmass(ALT)
+
+        # Only the headers are updated on disk, the data is left untouched
+        for file, airm in zip(files, airmass_calc):
+            with fits.open(file, mode="update") as hdu:
+                hdu[0].header.set('AIRMCALC', float(airm))
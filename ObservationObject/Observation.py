@@ -4,14 +4,117 @@
 # In[2]:
 
 
-from astropy.io import fits
+# astropy is only imported by the methods that use it, as importing it takes a while
+# and only the header cache (or fitsio) is needed to sort the files of a folder
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import errno
+from functools import lru_cache
 import numpy as np
-from os import listdir
-from os.path import isfile, join, getmtime, exists
+from os import scandir, cpu_count, strerror
+from os.path import isfile, exists
 import warnings
 
+# fitsio parses headers in C, which is a lot faster than astropy for the few 
+# header keywords needed to sort the files. Astropy is used if it's missing.
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+# The optional dependencies below only speed up the creation of the master frames. Like 
+# astropy, they are imported on first use, so that just sorting a folder doesn't pay for them
+
+@lru_cache(maxsize=None)
+def load_bottleneck():
+    """
+    Returns the bottleneck module, or None if it's missing. bottleneck finds the median of the 
+    (small) stacks with a quickselect in C, which beats numpy's median.
+    """
+    try:
+        import bottleneck
+    except ImportError:
+        return None
+    return bottleneck
+
+@lru_cache(maxsize=None)
+def load_numexpr():
+    """
+    Returns the numexpr module, or None if it's missing. Without numba, numexpr still evaluates 
+    the flat correction as a single expression (in blocks that stay in the cache), instead of 
+    a pass over the stack for every operation.
+    """
+    try:
+        import numexpr
+    except ImportError:
+        return None
+    return numexpr
+
+@lru_cache(maxsize=None)
+def load_normalize_flats():
+    """
+    Returns the numba compiled normalize_flats function, or None if numba is missing. numba fuses 
+    the correction and normalization of the flat frames into a single pass over each frame.
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+    
+    @njit(parallel=True, cache=True)
+    def normalize_flats(stack, bias, dark, exptimes):
+        """
+        Subtracts the bias and the exposure time scaled dark from every frame in the stack, 
+        and then divides each frame by its median. The stack is modified in place.
+        """
+        n, height, width = stack.shape
+        for i in prange(n):
+            frame = stack[i]
+            for y in range(height):
+                for x in range(width):
+                    frame[y, x] = frame[y, x] - bias[y, x] - dark[y, x] * exptimes[i]
+            
+            frameMedian = np.median(frame)
+            for y in range(height):
+                for x in range(width):
+                    frame[y, x] /= frameMedian
+    
+    return normalize_flats
+
+def median(data, axis=None):
+    """
+    Returns the median of data along the given axis, using bottleneck if it is available.
+    """
+    bn = load_bottleneck()
+    if bn is not None:
+        return bn.median(data, axis=axis)
+    return np.median(data, axis=axis)
+
+# Readers for the combinations of header keywords that are requested for every single file. 
+# These look up their keywords directly, instead of going through the general loop in get_file_info
+def info_imagetyp_exptime_filter(hduHeader):
+    return [hduHeader["IMAGETYP"], hduHeader["EXPTIME"], hduHeader["FILTER"]]
+
+def info_dateobs(hduHeader):
+    return [hduHeader["DATE-OBS"]]
+
+def info_exptime(hduHeader):
+    return [hduHeader["EXPTIME"]]
+
+def info_filter(hduHeader):
+    return [hduHeader["FILTER"]]
+
+def info_binning(hduHeader):
+    return [str(hduHeader["XBINNING"]) + "x" + str(hduHeader["YBINNING"])]
+
+file_info_readers = {
+    ("IMAGETYP", "EXPTIME", "FILTER"): info_imagetyp_exptime_filter,
+    ("DATE-OBS",): info_dateobs,
+    ("EXPTIME",): info_exptime,
+    ("FILTER",): info_filter,
+    ("BINNING",): info_binning,
+}
+
 class Observation:
     """
     This class provides a convenient way to access, view and manipulate the data of an observation
@@ -63,10 +166,17 @@ class Observation:
         
         # Check whether the (passed or deduced) folder actually exists
         if not exists(foldername):
-            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), foldername)
+            raise FileNotFoundError(errno.ENOENT, strerror(errno.ENOENT), foldername)
             
         # Prime the newly created object with some attributes
         self.foldername = foldername
+        self.header_cache = {}  # The header of every file that was read, see get_file_info
+        self.date_cache = {}    # The parsed creation time of every file, see get_creation_time
+        
+        # The master frames are only constructed once they're needed
+        self.masterBias = None
+        self.masterDark = None
+        self.masterFlats = None
         
         self.group_content()  # Group all the content of the folder
             
@@ -114,24 +224,35 @@ class Observation:
         darkFiles = []
         flatFiles = []
 
-        # Get the (valid!) files in the given folder, so either .fits or .fit
-        folderContent = [join(self.foldername, file) for file in listdir(self.foldername)
-                         if (isfile(join(self.foldername, file)
-                            and (file.endswith(".fits")
-                            or file.endswith(".FIT"))))]
+        # Get the (valid!) files in the given folder, so either .fits or .fit, together with their 
+        # modification date. A single pass of scandir gives the file type without an extra stat
+        with scandir(self.foldername) as entries:
+            folderContent = [(entry.path, entry.stat().st_mtime) for entry in entries
+                             if entry.is_file() and entry.name.lower().endswith((".fits", ".fit"))]
 
         # Sort the content on modification date
-        sortedContent = sorted(folderContent, key=getmtime)
+        sortedContent = [filename for filename, mtime in sorted(folderContent, key=lambda content: content[1])]
+        
+        # Reading the headers is mostly waiting on the disk, so read them in a pool of threads 
+        # first. This also fills the header cache for get_filters and get_binnings below
+        with ThreadPoolExecutor(max_workers=min(16, (cpu_count() or 1) * 2)) as executor:
+            fileInfos = list(executor.map(lambda filename: self.get_file_info(filename, keywords), sortedContent))
+        
+        # The list for each kind of image, in the order in which the image type is matched
+        typeLists = {"Bias": biasFiles, "Dark": darkFiles, "Flat": flatFiles, "Light": lightFiles}
+        
+        # The list each image type belongs to. There are only a few different image types
+        # (e.g. "Bias Frame"), so each of them only has to be matched once
+        imgtypeLists = {}
         
         # Loop over each file in the data dir       
-        for filename in sortedContent: 
-            imgtype, exptime, fltr = self.get_file_info(filename, keywords)
+        for filename, (imgtype, exptime, fltr) in zip(sortedContent, fileInfos): 
+            if imgtype not in imgtypeLists:
+                imgtypeLists[imgtype] = next((typeList for kind, typeList in typeLists.items() if kind in imgtype), None)
 
             # The following block orders the datafiles into the specified lists
-            if "Bias" in imgtype: biasFiles.append(filename)
-            elif "Dark" in imgtype: darkFiles.append(filename)
-            elif "Flat" in imgtype: flatFiles.append(filename)
-            elif "Light" in imgtype: lightFiles.append(filename)
+            typeList = imgtypeLists[imgtype]
+            if typeList is not None: typeList.append(filename)
                 
         filterTypes = self.get_filters(sortedContent)
         binningTypes = self.get_binnings(sortedContent)
@@ -150,7 +271,9 @@ class Observation:
         Private method that reads a list of keywords, specified in header_keywords, in the header of
         the given file. Returns a list of the same size as header_keywords, with all the 
         resulting values. Introduces the (imaginary) "IMGSIZE" key, which is nothing more 
-        than a fancy string representation of the NAXIS1 and NAXIS2 key.
+        than a fancy string representation of the NAXIS1 and NAXIS2 key. The header of each file
+        is only read from disk once and then kept in self.header_cache, as the same files are 
+        looked into over and over again (e.g. by get_files, check_binning and sort_closest).
         
         Args:
             filename (string): the absolute path to the file that needs to be looked into
@@ -162,26 +285,41 @@ class Observation:
         """
         results = []
 
-        # Open fits file and read the header from the first HDU object
-        with fits.open(filename) as hduList:
-            hdu = hduList[0]
-            hduHeader = hdu.header
-
-            # Loop over every keyword and read the correspoding value
-            for keyword in header_keywords:
-                try:
-                    # Special custom keyword "IMGSIZE" (read method docstring)
-                    if keyword == "IMGSIZE":
-                        results.append(str(hduHeader["NAXIS1"]) + "x" + str(hduHeader["NAXIS2"]))
-                    # Another special custom keyword "IMGSIZE" (read method docstring)
-                    elif keyword == "BINNING":
-                        results.append(str(hduHeader["XBINNING"]) + "x" + str(hduHeader["YBINNING"]))
-                    else:
-                        results.append(hduHeader[keyword])
-                        
-                # The keyword might not exist or be specified
-                except:
-                    results.append("?")
+        # Only open the fits file and read the header from the first HDU object if not done before
+        hduHeader = self.header_cache.get(filename)
+        if hduHeader is None and fitsio is not None:
+            hduHeader = self.header_cache[filename] = fitsio.read_header(filename, ext=0)
+        elif hduHeader is None:
+            from astropy.io import fits
+            
+            # Only the first HDU is parsed, and the data is neither mapped nor scaled
+            hduHeader = self.header_cache[filename] = fits.getheader(filename, ext=0, memmap=False, 
+                                                                     do_not_scale_image_data=True)
+
+        # The most common combinations of keywords have a dedicated reader. If one of 
+        # the keywords is missing, the loop below takes care of that keyword
+        reader = file_info_readers.get(tuple(header_keywords))
+        if reader is not None:
+            try:
+                return reader(hduHeader)
+            except KeyError:
+                pass
+
+        # Loop over every keyword and read the correspoding value
+        for keyword in header_keywords:
+            try:
+                # Special custom keyword "IMGSIZE" (read method docstring)
+                if keyword == "IMGSIZE":
+                    results.append(str(hduHeader["NAXIS1"]) + "x" + str(hduHeader["NAXIS2"]))
+                # Another special custom keyword "IMGSIZE" (read method docstring)
+                elif keyword == "BINNING":
+                    results.append(str(hduHeader["XBINNING"]) + "x" + str(hduHeader["YBINNING"]))
+                else:
+                    results.append(hduHeader[keyword])
+                    
+            # The keyword might not exist or be specified
+            except:
+                results.append("?")
 
         return results
     
@@ -222,22 +360,33 @@ class Observation:
         """
         
         # Read the creation time of the target file from the header
-        target_time_str = self.get_file_info(target, ["DATE-OBS"])[0]
-        target_time = datetime.strptime(target_time_str, '%Y-%m-%dT%H:%M:%S.%f')
+        target_time = self.get_creation_time(target)
         
         # List to store tuples of the passed files: (filepath, creation_time)
-        file_time_lst = []
-        
-        # Loop over every passed file and get their creation time
-        for file in files:
-            filetime_str = self.get_file_info(file, ["DATE-OBS"])[0]
-            filetime = datetime.strptime(filetime_str, '%Y-%m-%dT%H:%M:%S.%f')
-            file_time_lst.append((file, filetime))
+        file_time_lst = [(file, self.get_creation_time(file)) for file in files]
         
         # Sort this list on their difference with the target file
         file_time_lst = sorted(file_time_lst, key=lambda x: abs(x[1] - target_time))
         return file_time_lst
     
+    def get_creation_time(self, filename):
+        """
+        Public method that returns the creation time of the given file, as stored in the DATE-OBS 
+        keyword of its header. Parsing the timestamp is relatively slow, and the same files are 
+        sorted over and over again, so the result for each file is kept in self.date_cache.
+        
+        Args:
+            filename (string): the path to the file whose creation time is returned.
+            
+        Returns:
+            creation_time (datetime.datetime): the creation time of the file.
+        """
+        creation_time = self.date_cache.get(filename)
+        if creation_time is None:
+            creation_time_str = self.get_file_info(filename, ["DATE-OBS"])[0]
+            creation_time = self.date_cache[filename] = datetime.strptime(creation_time_str, '%Y-%m-%dT%H:%M:%S.%f')
+        return creation_time
+    
     def get_file_clusters(self, files, step=3600):
         """ Function that splits the passed list of files into clusters.
             Clusters are groups of files that belong together, because 
@@ -250,15 +399,15 @@ class Observation:
             frames was probably taken halfway through the observation.
         """    
         # Sort the files on creation time
-        files_sorted = sorted(files, key=lambda file: datetime.strptime(fits.getval(file, 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f"))
+        files_sorted = sorted(files, key=self.get_creation_time)
 
         # Track the indices where a step takes place
         step_inds = []
 
         # Loop over each file and compare the creation time to the previous
-        prev_creation = datetime.strptime(fits.getval(files[0], 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f")
+        prev_creation = self.get_creation_time(files[0])
         for file in files_sorted:
-            creation_time = datetime.strptime(fits.getval(file, 'DATE-OBS'), "%Y-%m-%dT%H:%M:%S.%f")
+            creation_time = self.get_creation_time(file)
 
             # Store the current index if the time difference is high enough
             if (creation_time - prev_creation).total_seconds() > step:
@@ -297,16 +446,14 @@ class Observation:
             IncompatibleBinningError
             
         """
-        # First, assume every file is equally large
-        binning = self.get_file_info(files[0], ["BINNING"])[0]
+        # Get the binning of every file, which comes straight from the header cache
+        binnings = np.array([self.get_file_info(file, ["BINNING"])[0] for file in files])
         
-        # Then loop over every file and check their sizes
-        for file in files:
-            current_binning = self.get_file_info(file, ["BINNING"])[0]
-            
-            # If it differs from the first file, there's a problem
-            if current_binning != binning:
-                raise IncompatibleBinningError(file, binning, current_binning)
+        # Every file should be equally large as the first one, otherwise there's a problem
+        mismatches = np.flatnonzero(binnings != binnings[0])
+        if mismatches.size > 0:
+            first = mismatches[0]
+            raise IncompatibleBinningError(files[first], binnings[0], binnings[first])
         
         return
     
@@ -368,38 +515,51 @@ class Observation:
             masterBias (numpy.ndarray): returns a matrix that represents the master bias
             
         """
+        from astropy.io import fits
+        
         self.check_binning(biasFiles)
         
+        # The bias frames are usually stored as integers that all share the same BSCALE and BZERO. 
+        # Scaling is linear, so then the raw integers can be stacked as they are, and only their 
+        # median has to be scaled. Otherwise (or if some pixels are BLANK), the data is scaled first
+        scalings = {tuple(self.get_file_info(file, ["BSCALE", "BZERO"])) for file in biasFiles}
+        stackRaw = len(scalings) == 1 and all(self.get_file_info(file, ["BLANK"])[0] == "?" for file in biasFiles)
+        BSCALE, BZERO = [default if value == "?" else value for value, default in zip(next(iter(scalings)), (1, 0))]
+        
         stackedBiasData = None
         
         # Loop over each bias .fits file
         for i in range(len(biasFiles)):
             filename = biasFiles[i]
 
-            # Open fits file and read the header from the first HDU object
-            hduList = fits.open(filename)
-            hdu = hduList[0]
-            
-            # On the first loop, assign the hdu content to the variable
-            if stackedBiasData is None:
-                stackedBiasData = hdu.data 
-            # Afterwards, the content of each file can be stacked on axis=2
-            else:
-                stackedBiasData = np.dstack((stackedBiasData, hdu.data))
+            # Open the fits file, which is closed again once its data is stacked
+            with fits.open(filename, do_not_scale_image_data=stackRaw) as hduList:
+                hdu = hduList[0]
+                
+                # On the first loop, allocate the stack for all the files at once
+                if stackedBiasData is None:
+                    dtype = hdu.data.dtype.newbyteorder("=") if stackRaw else np.float32
+                    stackedBiasData = np.empty((len(biasFiles),) + hdu.data.shape, dtype=dtype)
+                # The content of each file is stacked on axis=0
+                stackedBiasData[i] = hdu.data
 
         # One-dimensionalize the stacked data if needed
         if len(biasFiles) > 1:
-            # Take the median of each row along axis=2
-            masterBias = np.median(stackedBiasData, axis=2)
+            # Take the median of each pixel along axis=0
+            masterBias = median(stackedBiasData, axis=0)
         else:
-            masterBias = stackedBiasData
+            masterBias = stackedBiasData[0]
+            
+        # Scale the median of the raw data to the actual values
+        if stackRaw:
+            masterBias = (np.asarray(masterBias, dtype=np.float64) * BSCALE + BZERO).astype(np.float32)
 
         # Store the master Bias for later reference
         self.masterBias = masterBias
         
         return masterBias
     
-    def create_master_dark(self, darkFiles, masterBias):
+    def create_master_dark(self, darkFiles, masterBias=None):
         """
         Creates the master dark matrix for all known dark files (unless darkFiles argument is passed).
         If a masterBias matrix is provided, then this one will be used in the construction of the master
@@ -417,7 +577,13 @@ class Observation:
             
         """
             
+        from astropy.io import fits
+        
         self.check_binning(darkFiles)
+        
+        # Use our own master bias if none was passed, which is only constructed if not done before
+        if masterBias is None:
+            masterBias = self.masterBias if self.masterBias is not None else self.create_master_bias(self.biasFiles)
             
         # List to keep track of the exposure times of each dark frame
         EXPTIMEs = np.zeros(len(darkFiles))
@@ -429,24 +595,23 @@ class Observation:
         for i in range(len(darkFiles)):
             filename = darkFiles[i]
 
-            # Open fits file and read the header from the first HDU object
-            hduList = fits.open(filename)
-            hdu = hduList[0]
-            hduHeader = hdu.header
-
-            # This block reads the EXPTIME keyword from the header and stores it in a list
-            EXPTIME = hduHeader["EXPTIME"]
+            # This block reads the EXPTIME keyword from the (cached) header and stores it in a list
+            EXPTIME = self.get_file_info(filename, ["EXPTIME"])[0]
             EXPTIMEs[i] = EXPTIME
-            
-            # Subtract the masterBias frame
-            darkBiasCorrected = hdu.data - masterBias 
 
-            # On the first loop, assign the hdu content to the variable
-            if stackedDarkData is None:
-                stackedDarkData = darkBiasCorrected 
-            # Afterwards, the content of each file can be stacked on axis=2
-            else:
-                stackedDarkData = np.dstack((stackedDarkData,darkBiasCorrected))
+            # Open the fits file, which is closed again once its data is stacked
+            with fits.open(filename) as hduList:
+                hdu = hduList[0]
+                
+                # On the first loop, allocate the stack for all the files at once
+                if stackedDarkData is None:
+                    stackedDarkData = np.empty((len(darkFiles),) + hdu.data.shape, dtype=np.float32)
+
+                # The content of each file is stacked on axis=0
+                np.copyto(stackedDarkData[i], hdu.data)
+
+        # Subtract the masterBias frame from all the frames at once
+        stackedDarkData -= masterBias
 
         # For the best results, all exposure times should more or less be the same, so check that
         avgEXPTIME = EXPTIMEs.mean()
@@ -458,20 +623,20 @@ class Observation:
             
         # One-dimensionalize the stacked data if needed
         if len(darkFiles) > 1:
-            # Take the median of each row along axis=2
-            masterDarkUnnorm = np.median(stackedDarkData, axis=2)
+            # Take the median of each pixel along axis=0
+            masterDarkUnnorm = median(stackedDarkData, axis=0)
         else:
-            masterDarkUnnorm = stackedDarkData
+            masterDarkUnnorm = stackedDarkData[0]
 
         # Normalize the frame by dividing by the average exposure time
-        masterDark = masterDarkUnnorm / avgEXPTIME
+        masterDark = masterDarkUnnorm / np.float32(avgEXPTIME)
 
         # Store the master Dark for later reference
         self.masterDark = masterDark
 
         return masterDark
     
-    def create_master_flats(self, flatFiles, filterTypes, masterDark, masterBias):
+    def create_master_flats(self, flatFiles, filterTypes, masterDark=None, masterBias=None):
         """
         Creates the master flat field matrices for all known flat files (unless flatFiles argument is
         passed) for all the known filters (unless filterTypes argument is passed). Uses the passed masterBias or
@@ -495,65 +660,91 @@ class Observation:
                                                 (axis=2) in the same order as the specified filterTypes.
             
         """
+        from astropy.io import fits
+        
         self.check_binning(flatFiles)
         
+        # Use our own master frames if none were passed, which are only constructed if not done before
+        if masterBias is None:
+            masterBias = self.masterBias if self.masterBias is not None else self.create_master_bias(self.biasFiles)
+        if masterDark is None:
+            masterDark = self.masterDark if self.masterDark is not None else self.create_master_dark(self.darkFiles, masterBias)
+        
         length, width = masterBias.shape
         
-        # Variable that stores the master Flat for each filter type
-        masterFlats = None
+        # Variable that stores the master Flat for each filter type, stacked on axis=2
+        masterFlats = np.empty((length, width, len(filterTypes)), dtype=np.float32)
+        
+        # Group the flat files on their filter up front (the headers are cached anyway), 
+        # so that the loop over each filter type only has to open its own files
+        filterFiles = {filterType: [] for filterType in filterTypes}
+        for filename in flatFiles:
+            FILTER = self.get_file_info(filename, ["FILTER"])[0]
+            if FILTER in filterFiles:
+                filterFiles[FILTER].append(filename)
 
         # Each filter has its own masterFilter, so first we loop over each filter type
         for f in range(len(filterTypes)):
             filterType = filterTypes[f]
+            
+            # The flat files that use the filter we're currently interested in
+            fltrFiles = filterFiles[filterType]
+            nStacked = len(fltrFiles)
 
             stackedFlatData = None
+            EXPTIMEs = np.empty(nStacked)
             
             # Loop over each flat .fits file
-            for i in range(len(flatFiles)):
-                filename = flatFiles[i]
-
-                # Open fits file and read the header from the first HDU object
-                hduList = fits.open(filename)
-                hdu = hduList[0]
-                hduHeader = hdu.header
+            for i in range(nStacked):
+                filename = fltrFiles[i]
 
-                # Check whether the data uses the same filter as we're currently interested in
-                FILTER = hduHeader["FILTER"]
-                if FILTER != filterType: continue  # If not, we continue to the next file
-
-                # This block reads the EXPTIME keyword from the header
-                EXPTIME = hduHeader["EXPTIME"]
-                masterDarkScaled = masterDark * EXPTIME  # Scale the masterDark to the current exposure time
+                # This block reads the EXPTIME keyword from the (cached) header
+                EXPTIMEs[i] = self.get_file_info(filename, ["EXPTIME"])[0]
                 
-                # Correct the frame by subtracting bias and dark currents
-                flatBiasDarkCorrected = hdu.data - masterBias - masterDarkScaled
-
-                # Normalize the frame by dividing by the median value
-                frameMedian = np.median(flatBiasDarkCorrected)
-                flatNormalized = flatBiasDarkCorrected / frameMedian
-
-                # On the first loop, assign the hdu content to the variable
-                if stackedFlatData is None:
-                    stackedFlatData = flatNormalized 
-                # Afterwards, the content of each file can be stacked on axis=2
-                else:
-                    stackedFlatData = np.dstack((stackedFlatData, flatNormalized))
+                # Open the fits file, which is closed again once its data is stacked
+                with fits.open(filename) as hduList:
+                    hdu = hduList[0]
+
+                    # On the first loop, allocate the stack for all the files at once
+                    if stackedFlatData is None:
+                        stackedFlatData = np.empty((nStacked,) + hdu.data.shape, dtype=np.float32)
+                    
+                    # The content of each file is stacked on axis=0
+                    np.copyto(stackedFlatData[i], hdu.data)
+            
+            # Correct all the frames by subtracting bias and dark currents, where the masterDark 
+            # is scaled to the exposure time of each frame, and normalize each frame by its median
+            normalize_flats = load_normalize_flats()
+            ne = load_numexpr() if normalize_flats is None else None
+            if normalize_flats is not None:
+                normalize_flats(stackedFlatData, np.asarray(masterBias, dtype=np.float32), 
+                                np.asarray(masterDark, dtype=np.float32), EXPTIMEs)
+            elif ne is not None:
+                variables = {"stack": stackedFlatData, "bias": np.asarray(masterBias, dtype=np.float32), 
+                             "dark": np.asarray(masterDark, dtype=np.float32), 
+                             "exptime": EXPTIMEs.astype(np.float32)[:, np.newaxis, np.newaxis]}
+                ne.evaluate("stack - bias - dark * exptime", local_dict=variables, out=stackedFlatData)
+                
+                variables = {"stack": stackedFlatData, 
+                             "frameMedian": median(stackedFlatData.reshape(nStacked, -1), axis=1).astype(np.float32)[:, np.newaxis, np.newaxis]}
+                ne.evaluate("stack / frameMedian", local_dict=variables, out=stackedFlatData)
+            else:
+                stackedFlatData -= masterBias
+                stackedFlatData -= masterDark * EXPTIMEs[:, np.newaxis, np.newaxis]
+                stackedFlatData /= median(stackedFlatData.reshape(nStacked, -1), axis=1)[:, np.newaxis, np.newaxis]
 
             # One-dimensionalize the stacked data if needed
-            if len(flatFiles) > 1:
+            if nStacked > 1:
                 # Gives the masterFlat for the current filter as the median
-                masterFlat = np.median(stackedFlatData, axis=2)
+                masterFlat = median(stackedFlatData, axis=0)
             else:
-                masterFlat = stackedFlatData
+                masterFlat = stackedFlatData[0]
                 
-            #  Replace 0-values with something very small: 1e-100
-            masterFlat = np.where(masterFlat==0, 1e-100, masterFlat)
+            #  Replace 0-values with something very small, the smallest normal float32 (1e-100 would be 0)
+            masterFlat = np.where(masterFlat==0, np.finfo(np.float32).tiny, masterFlat)
             
             # Store this 2D masterFlat in the 3D list of masterFlats
-            if masterFlats is None:
-                masterFlats = masterFlat
-            else:
-                masterFlats = np.dstack((masterFlats, masterFlat))
+            masterFlats[:, :, f] = masterFlat
 
         # Store the master Flats for later reference
         if filterTypes == self.filters and flatFiles == self.flatFiles: